@@ -0,0 +1,341 @@
+"""
+In-process volume copy engine.
+
+Copies a source device or image onto a destination while skipping the
+regions that hold no data:
+
+ * holes reported by SEEK_DATA/SEEK_HOLE (regular files),
+ * chunks that read back as all zeroes (block devices).
+
+Skipped regions are zeroed on the destination with BLKZEROOUT (block
+devices, usually offloaded) or hole punching (regular files), so copy
+time scales with the data actually used. Data goes through page aligned
+buffers with O_DIRECT when both ends support it, so the page cache is
+not thrashed; regular file to regular file copies use copy_file_range.
+
+All calls block, run them with eventlet.tpool from green code.
+"""
+
+import ctypes
+import errno
+import fcntl
+import os
+import stat
+import struct
+
+from eventlet import patcher
+
+# copy_range runs in native threads
+_threading = patcher.original('threading')
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+O_DIRECT = getattr(os, 'O_DIRECT', 0o40000)
+
+BLKZEROOUT = 0x127f
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+ALIGN = 4096
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        for name in ('pread', 'pwrite'):
+            func = getattr(libc, name)
+            func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_int64]
+            func.restype = ctypes.c_ssize_t
+        libc.memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                ctypes.c_size_t]
+        libc.memcmp.restype = ctypes.c_int
+        libc.posix_memalign.argtypes = [ctypes.POINTER(ctypes.c_void_p),
+                                        ctypes.c_size_t, ctypes.c_size_t]
+        libc.free.argtypes = [ctypes.c_void_p]
+        libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_int64, ctypes.c_int64]
+        if hasattr(libc, 'copy_file_range'):
+            libc.copy_file_range.argtypes = [
+                ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                ctypes.c_size_t, ctypes.c_uint]
+            libc.copy_file_range.restype = ctypes.c_ssize_t
+        _libc = libc
+    return _libc
+
+
+def _raise_errno():
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code))
+
+
+class AlignedBuffer(object):
+    """A zero filled, ALIGN aligned buffer usable with O_DIRECT."""
+
+    def __init__(self, size):
+        libc = _get_libc()
+        self.size = size
+        self.ptr = ctypes.c_void_p()
+        if libc.posix_memalign(ctypes.byref(self.ptr), ALIGN, size) != 0:
+            raise MemoryError()
+        ctypes.memset(self.ptr, 0, size)
+
+    def free(self):
+        if self.ptr:
+            _get_libc().free(self.ptr)
+            self.ptr = ctypes.c_void_p()
+
+
+def _pread(fd, buf, length, offset):
+    """Read up to length bytes, returns less only at EOF."""
+    libc = _get_libc()
+    done = 0
+    while done < length:
+        n = libc.pread(fd, buf.ptr.value + done, length - done,
+                       offset + done)
+        if n < 0:
+            if ctypes.get_errno() == errno.EINTR:
+                continue
+            _raise_errno()
+        if n == 0:
+            break
+        done += n
+    return done
+
+
+def _pwrite(fd, buf, length, offset):
+    libc = _get_libc()
+    done = 0
+    while done < length:
+        n = libc.pwrite(fd, buf.ptr.value + done, length - done,
+                        offset + done)
+        if n < 0:
+            if ctypes.get_errno() == errno.EINTR:
+                continue
+            _raise_errno()
+        done += n
+
+
+def _open(path, flags, direct):
+    """Open path, with O_DIRECT if asked and supported by the target."""
+    if direct:
+        try:
+            return os.open(path, flags | O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags), False
+
+
+def data_extents(fd, start, end):
+    """Yield (offset, length) of the regions of [start, end) holding data.
+
+    Files or devices which don't support SEEK_DATA are one data extent.
+    """
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole up to EOF
+                return
+            yield offset, end - offset
+            return
+        if data >= end:
+            return
+        try:
+            hole = min(os.lseek(fd, data, SEEK_HOLE), end)
+        except OSError:
+            hole = end
+        yield data, hole - data
+        offset = hole
+
+
+class VolumeCopier(object):
+    """Copy `size` bytes from `src` to `dst`.
+
+    copy_range() may be called concurrently from several native threads
+    on disjoint ranges; each call uses its own buffer.
+    """
+
+    def __init__(self, src, dst, size, chunk_size, direct=True):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.chunk_size = max(ALIGN, chunk_size - chunk_size % ALIGN)
+        self.direct = direct
+        self._src_fd = self._dst_fd = self._dst_buffered_fd = None
+        self._extend_lock = _threading.Lock()
+
+    def open(self):
+        self._src_fd, src_direct = _open(self.src, os.O_RDONLY, self.direct)
+        self._dst_fd, dst_direct = _open(self.dst, os.O_WRONLY, self.direct)
+        self.direct = src_direct and dst_direct
+        mode = os.fstat(self._dst_fd).st_mode
+        self._dst_is_blk = stat.S_ISBLK(mode)
+        self._dst_is_reg = stat.S_ISREG(mode)
+        self._src_is_reg = stat.S_ISREG(os.fstat(self._src_fd).st_mode)
+        # unaligned tails can't go through O_DIRECT
+        self._dst_buffered_fd = (os.open(self.dst, os.O_WRONLY)
+                                 if dst_direct else self._dst_fd)
+
+    def close(self, sync=False):
+        if sync and self._dst_fd is not None:
+            os.fdatasync(self._dst_fd)
+        for fd in set([self._src_fd, self._dst_fd, self._dst_buffered_fd]):
+            if fd is not None:
+                os.close(fd)
+        self._src_fd = self._dst_fd = self._dst_buffered_fd = None
+
+    def sync(self):
+        """Make everything written so far durable."""
+        os.fdatasync(self._dst_fd)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _zero(self, offset, length, zeros):
+        if not length:
+            return
+        if self._dst_is_blk:
+            try:
+                fcntl.ioctl(self._dst_fd, BLKZEROOUT,
+                            struct.pack('QQ', offset, length))
+                return
+            except IOError:
+                pass
+        elif self._dst_is_reg:
+            if _get_libc().fallocate(
+                    self._dst_fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                    offset, length) == 0:
+                return
+        end = offset + length
+        while offset < end:
+            n = min(zeros.size, end - offset)
+            self._write(zeros, n, offset)
+            offset += n
+
+    def _extend(self, end):
+        """Grow a regular destination to `end`, punched holes don't."""
+        with self._extend_lock:
+            if os.fstat(self._dst_fd).st_size < end:
+                os.ftruncate(self._dst_fd, end)
+
+    def _write(self, buf, length, offset):
+        fd = self._dst_fd
+        if self.direct and (length % ALIGN or offset % ALIGN):
+            fd = self._dst_buffered_fd
+        _pwrite(fd, buf, length, offset)
+
+    def _copy_file_range(self, offset, length):
+        """Kernel side copy between regular files, False if unsupported."""
+        libc = _get_libc()
+        if not hasattr(libc, 'copy_file_range'):
+            return False
+        off_in = ctypes.c_int64(offset)
+        off_out = ctypes.c_int64(offset)
+        remaining = length
+        while remaining:
+            n = libc.copy_file_range(self._src_fd, ctypes.byref(off_in),
+                                     self._dst_fd, ctypes.byref(off_out),
+                                     remaining, 0)
+            if n < 0:
+                code = ctypes.get_errno()
+                if code == errno.EINTR:
+                    continue
+                if remaining == length and code in (errno.ENOSYS,
+                                                    errno.EXDEV,
+                                                    errno.EINVAL,
+                                                    errno.EOPNOTSUPP):
+                    return False
+                _raise_errno()
+            if n == 0:
+                break
+            remaining -= n
+        return True
+
+    def copy_range(self, start, end, progress=None):
+        """Copy [start, end), returns (bytes copied, bytes zeroed).
+
+        `progress`, if given, is called with the number of bytes handled
+        after every chunk.
+        """
+        libc = _get_libc()
+        buf = AlignedBuffer(self.chunk_size)
+        zeros = AlignedBuffer(self.chunk_size)
+        copied = zeroed = 0
+        try:
+            offset = start
+            for data_start, data_len in data_extents(self._src_fd, start,
+                                                     end):
+                # the hole in front of this extent
+                self._zero(offset, data_start - offset, zeros)
+                zeroed += data_start - offset
+                if progress:
+                    progress(data_start - offset)
+                offset = data_start
+                data_end = data_start + data_len
+
+                if (self._src_is_reg and self._dst_is_reg and not
+                        self.direct and
+                        self._copy_file_range(data_start, data_len)):
+                    copied += data_len
+                    if progress:
+                        progress(data_len)
+                    offset = data_end
+                    continue
+
+                zero_start = None
+                while offset < data_end:
+                    n = min(self.chunk_size, data_end - offset)
+                    got = _pread(self._src_fd, buf, n, offset)
+                    if got == 0:
+                        # source shorter than requested, zero the rest
+                        data_end = offset
+                        break
+                    if libc.memcmp(buf.ptr, zeros.ptr, got) == 0:
+                        if zero_start is None:
+                            zero_start = offset
+                        zeroed += got
+                    else:
+                        if zero_start is not None:
+                            self._zero(zero_start, offset - zero_start,
+                                       zeros)
+                            zero_start = None
+                        self._write(buf, got, offset)
+                        copied += got
+                    offset += got
+                    if progress:
+                        progress(got)
+                if zero_start is not None:
+                    self._zero(zero_start, offset - zero_start, zeros)
+            # trailing hole
+            self._zero(offset, end - offset, zeros)
+            if self._dst_is_reg:
+                self._extend(end)
+            zeroed += end - offset
+            if progress:
+                progress(end - offset)
+        finally:
+            buf.free()
+            zeros.free()
+        return copied, zeroed
+
+
+def copy(src, dst, size, chunk_size, sync=False):
+    """Copy size bytes from src to dst, returns (copied, zeroed) bytes."""
+    with VolumeCopier(src, dst, size, chunk_size) as copier:
+        result = copier.copy_range(0, size)
+        copier.close(sync=sync)
+    return result
@@ -0,0 +1,215 @@
+"""
+In-memory index of the host block devices, kept current by kernel uevents.
+
+The index is filled from sysfs once, then a NETLINK_KOBJECT_UEVENT socket
+reports every disk the kernel adds, resizes or removes, so listing the
+devices neither forks lsblk nor needs a SCSI rescan to notice hot-plugged
+disks.
+"""
+
+import errno
+import os
+import socket as pysocket
+
+import eventlet
+from eventlet.green import socket
+
+from wormhole.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+SO_RCVBUF_SIZE = 4 * 1024 * 1024
+
+SYS_BLOCK = '/sys/block'
+SECTOR_SIZE = 512
+
+
+def human_size(nbytes):
+    """Format a size the way lsblk does, e.g. 3G or 1.5T."""
+    size, exp = float(nbytes), 0
+    while size >= 1024 and exp < 6:
+        size /= 1024
+        exp += 1
+    suffix = 'BKMGTPE'[exp]
+    whole = int(size)
+    dec = int(round((size - whole) * 10))
+    if dec == 10:
+        whole, dec = whole + 1, 0
+    if dec:
+        return '%d.%d%s' % (whole, dec, suffix)
+    return '%d%s' % (whole, suffix)
+
+
+def _read_attr(*parts):
+    try:
+        with open(os.path.join(*parts)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def read_device(name):
+    """Describe /sys/block/<name>, None if it's gone or not a disk."""
+    base = os.path.join(SYS_BLOCK, name)
+    dev = _read_attr(base, 'dev')
+    size = _read_attr(base, 'size')
+    if dev is None or size is None:
+        return None
+    # SCSI type 5 is a cdrom, lsblk calls it rom
+    if _read_attr(base, 'device', 'type') == '5':
+        return None
+    nbytes = int(size) * SECTOR_SIZE
+    return {'name': '/dev/' + name,
+            'type': 'disk',
+            'maj:min': dev,
+            'size': human_size(nbytes),
+            'bytes': nbytes,
+            'serial': (_read_attr(base, 'serial') or
+                       _read_attr(base, 'device', 'serial')),
+            'wwn': (_read_attr(base, 'wwid') or
+                    _read_attr(base, 'device', 'wwid'))}
+
+
+def scan_devices():
+    """Describe every disk under /sys/block, by device path."""
+    devices = {}
+    for name in os.listdir(SYS_BLOCK):
+        device = read_device(name)
+        if device is not None:
+            devices[device['name']] = device
+    return devices
+
+
+def read_partitions():
+    """Sizes in bytes of the disks and partitions in /proc/partitions.
+
+    The kernel only lists block devices with a capacity there.
+    """
+    sizes = {}
+    with open('/proc/partitions') as f:
+        for line in f:
+            fields = line.split()
+            # header: major minor #blocks name
+            if len(fields) == 4 and fields[0].isdigit():
+                sizes[fields[3]] = int(fields[2]) * 1024
+    return sizes
+
+
+class DeviceSnapshot(object):
+    """The block devices as seen at one point in time.
+
+    Meant to be taken once per reconciliation and queried for every
+    volume, instead of forking lsblk or fdisk each time.
+    """
+
+    def __init__(self, devices=None):
+        self._devices = scan_devices() if devices is None else \
+            dict((d['name'], d) for d in devices)
+        self._partitions = read_partitions()
+
+    def list(self):
+        return sorted(self._devices.values(), key=lambda d: d['name'])
+
+    def exists(self, path):
+        """Whether `path` is a disk or partition with a capacity."""
+        return os.path.basename(os.path.realpath(path)) in self._partitions
+
+    def size(self, path):
+        """Size in bytes of `path`, None if it doesn't exist."""
+        return self._partitions.get(os.path.basename(os.path.realpath(path)))
+
+
+def parse_uevent(data):
+    """Parse an 'action@devpath\\0KEY=VALUE\\0...' kernel uevent."""
+    lines = data.split('\0')
+    if '@' not in lines[0]:
+        # not from the kernel (e.g. libudev), ignore
+        return None
+    event = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition('=')
+        if sep:
+            event[key] = value
+    return event
+
+
+class DeviceIndex(object):
+    """The block devices of the host, updated on kernel uevents."""
+
+    def __init__(self):
+        self._devices = {}
+        self._sock = None
+
+    def start(self):
+        sock = socket.socket(pysocket.AF_NETLINK, pysocket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+        try:
+            sock.setsockopt(pysocket.SOL_SOCKET, pysocket.SO_RCVBUF,
+                            SO_RCVBUF_SIZE)
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        # subscribe first so nothing falls between the scan and the events
+        self._devices = scan_devices()
+        eventlet.spawn_n(self._watch)
+
+    @property
+    def running(self):
+        return self._sock is not None
+
+    def _watch(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOBUFS:
+                    LOG.warn("Lost block device uevents, rescanning sysfs")
+                    self._devices = scan_devices()
+                    continue
+                LOG.warn("Stop watching block device uevents: %s", e)
+                self._sock.close()
+                self._sock = None
+                return
+            event = parse_uevent(data)
+            if not event or event.get('SUBSYSTEM') != 'block' or \
+                    event.get('DEVTYPE') != 'disk':
+                continue
+            name = event.get('DEVNAME', '')
+            path = '/dev/' + os.path.basename(name)
+            if event.get('ACTION') == 'remove':
+                LOG.debug("Block device %s removed", path)
+                self._devices.pop(path, None)
+            elif event.get('ACTION') in ('add', 'change', 'online'):
+                device = read_device(os.path.basename(name))
+                if device is not None:
+                    LOG.debug("Block device %s %s: %s", path,
+                              event['ACTION'], device)
+                    self._devices[path] = device
+
+    def list(self):
+        return sorted(self._devices.values(), key=lambda d: d['name'])
+
+
+_index = None
+
+
+def get_index():
+    """The running device index, or None if uevents can't be watched."""
+    global _index
+    if _index is None:
+        _index = DeviceIndex()
+        try:
+            _index.start()
+        except (IOError, OSError, pysocket.error) as e:
+            LOG.warn("Can't watch block device uevents: %s", e)
+    return _index if _index.running else None
+
+
+def snapshot():
+    """A DeviceSnapshot, built on the uevent index if it's running."""
+    index = get_index()
+    return DeviceSnapshot(index.list() if index is not None else None)
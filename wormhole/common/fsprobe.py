@@ -0,0 +1,310 @@
+"""
+Find the root filesystem of a disk from its superblocks.
+
+The partitions of the disk, and the LVM volumes on them, are ranked from
+what their superblocks and partition table entries say (filesystem type,
+label, GPT partition type, LV name, size) without mounting them. Only the
+best candidates are then mounted, read-only and without journal replay,
+until one has a root directory layout.
+
+Run as wormhole-rootprobe <disk>, prints the device of the root
+filesystem. Kept free of the service dependencies so the boot scripts
+can run it before the service is up.
+"""
+
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+SECTOR_SIZE = 512
+
+# directories a root filesystem has, as checked by the boot scripts
+ROOT_DIRS = ('home', 'boot', 'etc', 'var', 'opt', 'dev')
+
+EXT_SUPERBLOCK = 1024
+EXT_MAGIC = 0xEF53
+EXT_INCOMPAT_JOURNAL_DEV = 0x0008
+BTRFS_SUPERBLOCK = 0x10000
+BTRFS_MAGIC = '_BHRfS_M'
+
+# GPT partition types, from the discoverable partitions specification
+GPT_ROOT_TYPES = set([
+    '4f68bce3-e8cd-4db1-96e7-fbcaf984b709',  # x86-64
+    '44479540-f297-41b2-9af7-d131d5f0458a',  # x86
+    'b921b045-1df0-41c3-af44-4c6f280d3fae',  # arm64
+    '69dad710-2ce4-4e3c-b16c-21a1d49abed3',  # arm
+])
+GPT_OTHER_TYPES = set([
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b',  # EFI system
+    'bc13c2ff-59e6-4262-a352-b275fd6f7172',  # extended boot loader
+    '21686148-6449-6e6f-744e-656564454649',  # BIOS boot
+    '933ac7e1-2eb4-4f13-b844-0e14e2aef915',  # home
+    '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f',  # swap
+    'e6d6d379-f507-44c2-a23c-238f2a3df928',  # LVM
+])
+MBR_TYPE_LINUX = 0x83
+MBR_OTHER_TYPES = set([0x82, 0x8e, 0xef, 0x05, 0x0f, 0x85])
+
+ROOT_NAMES = ('root', 'rootfs', '/', 'cloudimg-rootfs', 'img-rootfs')
+OTHER_NAMES = ('boot', '/boot', 'efi', 'home', '/home', 'swap', 'var',
+               'tmp', 'data')
+
+
+def _read(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _uuid(raw):
+    h = raw.encode('hex')
+    return '-'.join([h[:8], h[8:12], h[12:16], h[16:20], h[20:]])
+
+
+def _guid(raw):
+    # mixed endian, as stored in GPT entries
+    a, b, c = struct.unpack('<IHH', raw[:8])
+    return '%08x-%04x-%04x-%s-%s' % (a, b, c, raw[8:10].encode('hex'),
+                                     raw[10:16].encode('hex'))
+
+
+def _label(raw):
+    return raw.split('\0', 1)[0].strip()
+
+
+def read_superblock(path):
+    """Identify the filesystem on `path`: a dict with fstype, label and
+    uuid, fstype being one of ext, xfs, btrfs, swap, LVM2_member,
+    vfat or None.
+    """
+    info = {'fstype': None, 'label': '', 'uuid': ''}
+    head = _read(path, 0, 8192)
+    ext = head[EXT_SUPERBLOCK:EXT_SUPERBLOCK + 256]
+    if len(ext) == 256 and struct.unpack('<H', ext[56:58])[0] == EXT_MAGIC:
+        incompat = struct.unpack('<I', ext[96:100])[0]
+        if not incompat & EXT_INCOMPAT_JOURNAL_DEV:
+            info.update(fstype='ext', uuid=_uuid(ext[104:120]),
+                        label=_label(ext[120:136]))
+        return info
+    if head[:4] == 'XFSB':
+        info.update(fstype='xfs', uuid=_uuid(head[32:48]),
+                    label=_label(head[108:120]))
+        return info
+    for sector in range(4):
+        label = head[sector * SECTOR_SIZE:sector * SECTOR_SIZE + 32]
+        if label[:8] == 'LABELONE' and label[24:32] == 'LVM2 001':
+            info['fstype'] = 'LVM2_member'
+            return info
+    if 'SWAPSPACE2' in (head[4086:4096], head[8182:8192]):
+        info['fstype'] = 'swap'
+        return info
+    if head[510:512] == '\x55\xaa' and (head[82:87] == 'FAT32' or
+                                         head[54:57] == 'FAT'):
+        info['fstype'] = 'vfat'
+        return info
+    btrfs = _read(path, BTRFS_SUPERBLOCK, 0x22b)
+    if btrfs[0x40:0x48] == BTRFS_MAGIC:
+        info.update(fstype='btrfs', uuid=_uuid(btrfs[0x20:0x30]),
+                    label=_label(btrfs[0x12b:0x22b]))
+    return info
+
+
+def read_partition_types(disk):
+    """Partition number -> (type, bootable) from the partition table of
+    `disk`. The type is a GUID string for GPT, an int for MBR.
+    """
+    types = {}
+    head = _read(disk, 0, 2 * SECTOR_SIZE)
+    if len(head) < 2 * SECTOR_SIZE or head[510:512] != '\x55\xaa':
+        return types
+    if head[SECTOR_SIZE:SECTOR_SIZE + 8] == 'EFI PART':
+        gpt = head[SECTOR_SIZE:]
+        entries_lba, count, entry_size = struct.unpack('<QII', gpt[72:88])
+        entries = _read(disk, entries_lba * SECTOR_SIZE,
+                        min(count, 256) * entry_size)
+        for i in range(len(entries) // entry_size):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            if entry[:16].strip('\0'):
+                # attribute bit 2: legacy BIOS bootable
+                attrs = struct.unpack('<Q', entry[48:56])[0]
+                types[i + 1] = (_guid(entry[:16]), bool(attrs & 4))
+        return types
+    for i in range(4):
+        entry = head[446 + 16 * i:446 + 16 * (i + 1)]
+        if ord(entry[4]):
+            types[i + 1] = (ord(entry[4]), ord(entry[0]) == 0x80)
+    return types
+
+
+def _sys_attr(name, attr):
+    try:
+        with open(os.path.join(SYS_CLASS_BLOCK, name, attr)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _holders(name):
+    path = os.path.join(SYS_CLASS_BLOCK, name, 'holders')
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def _dm_path(name):
+    dm_name = _sys_attr(name, 'dm/name')
+    if dm_name and os.path.exists('/dev/mapper/' + dm_name):
+        return '/dev/mapper/' + dm_name, dm_name
+    return '/dev/' + name, dm_name or name
+
+
+def list_candidates(disk):
+    """The disk, its partitions and the device mapper volumes on them,
+    as dicts with path, name, size and the partition number and type.
+    """
+    disk_name = os.path.basename(os.path.realpath(disk))
+    candidates = []
+    names = [disk_name] + sorted(
+        n for n in os.listdir(os.path.join(SYS_CLASS_BLOCK, disk_name))
+        if _sys_attr(n, 'partition') is not None)
+    for name in names:
+        candidates.append({'path': '/dev/' + name, 'name': name,
+                           'partition': int(_sys_attr(name, 'partition') or 0),
+                           'size': int(_sys_attr(name, 'size') or 0) *
+                           SECTOR_SIZE})
+    for candidate in list(candidates):
+        for holder in _holders(candidate['name']):
+            path, dm_name = _dm_path(holder)
+            candidates.append({'path': path, 'name': dm_name,
+                               'partition': 0,
+                               'size': int(_sys_attr(holder, 'size') or 0) *
+                               SECTOR_SIZE})
+    return candidates
+
+
+def _has_unheld_pv(candidates):
+    return any(c['fstype'] == 'LVM2_member' and not _holders(c['name'])
+               for c in candidates)
+
+
+def score(candidate):
+    """How likely `candidate` holds the root filesystem, None if it
+    can't at all.
+    """
+    if candidate['fstype'] not in ('ext', 'xfs', 'btrfs'):
+        return None
+    points = 10
+    part_type, bootable = candidate.get('part_type', (None, False))
+    if part_type in GPT_ROOT_TYPES:
+        points += 60
+    elif part_type in GPT_OTHER_TYPES or part_type in MBR_OTHER_TYPES:
+        points -= 50
+    elif part_type == MBR_TYPE_LINUX:
+        points += 5
+    for name in (candidate['label'].lower(), candidate['name'].lower()):
+        if name in ROOT_NAMES or name.endswith(('-root', '_root')):
+            points += 40
+        elif name in OTHER_NAMES or name.endswith(
+                tuple('-' + n for n in OTHER_NAMES)):
+            points -= 30
+    if bootable:
+        points += 5
+    return points
+
+
+def _describe(candidates, types):
+    for c in candidates:
+        c.update(read_superblock(c['path']))
+        if c['partition'] in types:
+            c['part_type'] = types[c['partition']]
+    return candidates
+
+
+def _activate_lvm():
+    try:
+        return subprocess.call(['vgchange', '-ay'], stdout=sys.stderr) == 0
+    except OSError:
+        return False
+
+
+def rank(disk):
+    """The candidates able to hold a root filesystem, best first."""
+    types = read_partition_types(disk)
+    candidates = _describe(list_candidates(disk), types)
+    # logical volumes are only visible once activated
+    if _has_unheld_pv(candidates) and _activate_lvm():
+        candidates = _describe(list_candidates(disk), types)
+    ranked = []
+    for c in candidates:
+        points = score(c)
+        if points is not None:
+            ranked.append((points, c['size'], c))
+    ranked.sort(key=lambda r: (r[0], r[1]), reverse=True)
+    return [c for _points, _size, c in ranked]
+
+
+def _is_root(mnt):
+    for d in ROOT_DIRS:
+        path = os.path.join(mnt, d)
+        if os.path.islink(path):
+            target = os.readlink(path)
+            # absolute links point into the filesystem, not the host
+            path = os.path.join(mnt, target.lstrip('/')) \
+                if os.path.isabs(target) else \
+                os.path.join(mnt, os.path.dirname(d), target)
+        if not os.path.isdir(path):
+            return False
+    return True
+
+
+def _mount_options(fstype):
+    # read-only, and without replaying the journal
+    return {'ext': ['ro,noload', 'ro'],
+            'xfs': ['ro,norecovery', 'ro'],
+            'btrfs': ['ro,nologreplay', 'ro']}.get(fstype, ['ro'])
+
+
+def confirm(candidate):
+    """Mount `candidate` read-only and check it looks like a root."""
+    mnt = tempfile.mkdtemp(prefix='rootprobe.')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for options in _mount_options(candidate['fstype']):
+                if subprocess.call(['mount', '-o', options,
+                                    candidate['path'], mnt],
+                                   stderr=devnull) == 0:
+                    break
+            else:
+                return False
+        try:
+            return _is_root(mnt)
+        finally:
+            subprocess.call(['umount', mnt])
+    finally:
+        os.rmdir(mnt)
+
+
+def find_root(disk):
+    """The device of the root filesystem on `disk`, or None."""
+    for candidate in rank(disk):
+        sys.stderr.write('root candidate %(path)s %(fstype)s label=%(label)r '
+                         'uuid=%(uuid)s size=%(size)d\n' % candidate)
+        if confirm(candidate):
+            return candidate['path']
+    return None
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: %s <disk>\n' % sys.argv[0])
+        return 2
+    root = find_root(sys.argv[1])
+    if root is None:
+        return 1
+    print(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Write a disk image onto a block device while it is being downloaded.
+
+Raw images are copied as they grow, so most of the work is done by the
+time the download ends. Other formats keep their metadata anywhere in the
+file and are converted by qemu-img once complete, with its parallel
+coroutines, bypassing the page cache and skipping zeroed clusters.
+"""
+
+import os
+import re
+
+from eventlet import tpool
+from oslo.config import cfg
+
+from wormhole import exception
+from wormhole.common import blockcopy
+from wormhole.common import inotify
+from wormhole.common import jsonutils
+from wormhole.common import log as logging
+from wormhole.common import units
+from wormhole.common import utils
+
+image_opts = [
+    cfg.BoolOpt('image_stream_raw',
+                default=True,
+                help='Copy raw images onto the device while they are '
+                     'downloaded. Needs the image written sequentially.'),
+    cfg.IntOpt('image_stream_step',
+               default=64,
+               help='Size in MB of the downloaded data a streamed image '
+                    'copy waits for before copying it.'),
+    cfg.IntOpt('image_convert_coroutines',
+               default=8,
+               help='Number of parallel coroutines of qemu-img convert '
+                    '(-m).'),
+    cfg.BoolOpt('image_convert_out_of_order',
+                default=True,
+                help='Let qemu-img convert write out of order (-W).'),
+    cfg.BoolOpt('image_convert_direct_io',
+                default=True,
+                help='Bypass the page cache while converting images '
+                     '(-t none -T none).'),
+    cfg.StrOpt('image_convert_sparse_size',
+               default='64k',
+               help='Zeroed runs of this size are skipped rather than '
+                    'written by qemu-img convert (-S).'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(image_opts)
+
+LOG = logging.getLogger(__name__)
+
+# the header has to be in to know the format
+PROBE_SIZE = 512
+
+# (offset, magic, qemu-img format)
+_MAGICS = [
+    (0, 'QFI\xfb', 'qcow2'),
+    (0, 'QED\0', 'qed'),
+    (0, 'KDMV', 'vmdk'),
+    (0, '# Disk DescriptorFile', 'vmdk'),
+    (0, 'vhdxfile', 'vhdx'),
+    (0, 'conectix', 'vpc'),
+    (0x40, '\x7f\x10\xda\xbe', 'vdi'),
+]
+
+_PROGRESS_RE = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+_WATCH_MASK = (inotify.IN_CREATE | inotify.IN_MODIFY | inotify.IN_ATTRIB |
+               inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO)
+
+
+def detect_format(path):
+    """The qemu-img format of `path`, None until its header is in."""
+    with open(path, 'rb') as f:
+        head = f.read(PROBE_SIZE)
+    for offset, magic, fmt in _MAGICS:
+        if head[offset:offset + len(magic)] == magic:
+            return fmt
+    return 'raw' if len(head) == PROBE_SIZE else None
+
+
+def virtual_size(path, fmt):
+    out, _err = utils.execute('qemu-img', 'info', '-f', fmt,
+                              '--output=json', path)
+    return jsonutils.loads(out)['virtual-size']
+
+
+def _wait(paths, ready, progress=None):
+    """Sleep until ready() is true, woken by changes next to `paths`."""
+    with inotify.Inotify() as watcher:
+        for d in set(os.path.dirname(os.path.abspath(p)) for p in paths):
+            watcher.add_watch(d, _WATCH_MASK)
+        while not ready():
+            if progress:
+                # raises once the task is stopped
+                progress(0)
+            # the timeout covers changes made before the watches
+            watcher.wait(1)
+
+
+def convert(src, dst, fmt, progress=None):
+    """Convert the complete image `src` onto the device `dst`."""
+    cmd = ['qemu-img', 'convert', '-p', '-f', fmt, '-O', 'raw',
+           '-m', str(CONF.image_convert_coroutines),
+           '-S', CONF.image_convert_sparse_size]
+    if CONF.image_convert_out_of_order:
+        cmd.append('-W')
+    if CONF.image_convert_direct_io:
+        cmd += ['-t', 'none', '-T', 'none']
+    cmd += [src, dst]
+
+    state = {'pending': '', 'done': 0}
+
+    def _progress(data):
+        # qemu-img -p rewrites "    (12.34/100%)\r" on one line
+        lines = re.split(r'[\r\n]', state['pending'] + data)
+        state['pending'] = lines.pop()
+        for line in lines:
+            m = _PROGRESS_RE.search(line)
+            if m:
+                done = int(progress.total * float(m.group(1)) / 100)
+                progress(max(done - state['done'], 0))
+                state['done'] = max(done, state['done'])
+
+    if progress:
+        progress.total = virtual_size(src, fmt)
+    utils.execute(*cmd, stdout_callback=_progress if progress else None)
+    if progress:
+        progress(max(progress.total - state['done'], 0))
+
+
+def stream_raw(src, dst, downloaded, progress=None):
+    """Copy the raw image `src` onto `dst` as it is downloaded.
+
+    `downloaded` returns True once `src` is complete; until then only the
+    data written so far, in whole image_stream_step steps, is copied.
+    """
+    step = CONF.image_stream_step * units.Mi
+    state = {'done': 0, 'finished': False}
+
+    def _ready():
+        # check before the size, so the size is final once finished
+        state['finished'] = downloaded()
+        size = os.path.getsize(src)
+        if size < state['done']:
+            raise exception.ImageLoadFailed(
+                path=src, reason='shrunk while being downloaded')
+        if progress:
+            # what is downloaded so far, final once finished
+            progress.total = size
+        return state['finished'] or size - state['done'] >= step
+
+    copier = blockcopy.VolumeCopier(src, dst, 0, CONF.volume_copy_range_size
+                                    * units.Mi)
+    # blockcopy calls block, keep them off the hub
+    tpool.execute(copier.open)
+    LOG.debug("Stream %(src)s to %(dst)s, direct io: %(direct)s",
+              {'src': src, 'dst': dst, 'direct': copier.direct})
+    try:
+        while not state['finished']:
+            _wait([src], _ready, progress)
+            size = os.path.getsize(src)
+            end = size if state['finished'] else size - size % step
+            tpool.execute(copier.copy_range, state['done'], end, progress)
+            state['done'] = end
+        tpool.execute(copier.sync)
+    finally:
+        tpool.execute(copier.close)
+    if progress:
+        progress.total = state['done']
+    LOG.debug("Streamed %(size)d bytes of raw image %(src)s onto %(dst)s",
+              {'size': state['done'], 'src': src, 'dst': dst})
+
+
+def load(src, dst, downloaded, progress=None):
+    """Write the image `src` onto `dst`, starting while it downloads.
+
+    Returns False if the download ended without an image.
+    """
+    def _probed():
+        return ((os.path.exists(src) and detect_format(src) is not None)
+                or downloaded())
+
+    _wait([src], _probed, progress)
+    if not os.path.exists(src):
+        LOG.info("No image downloaded at %s", src)
+        return False
+    fmt = detect_format(src) or 'raw'
+    LOG.info("Load %(fmt)s image %(src)s onto %(dst)s",
+             {'fmt': fmt, 'src': src, 'dst': dst})
+    if fmt == 'raw' and CONF.image_stream_raw:
+        stream_raw(src, dst, downloaded, progress)
+    else:
+        _wait([src], downloaded, progress)
+        convert(src, dst, fmt, progress)
+    return True
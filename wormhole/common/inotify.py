@@ -0,0 +1,78 @@
+"""
+Minimal inotify binding for greenthreads.
+
+Only what is needed to sleep until something changes in a directory:
+add watches, then wait (cooperatively) for any event or a timeout.
+"""
+
+import ctypes
+import errno
+import os
+
+from eventlet.green import select
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    return _libc
+
+
+class Inotify(object):
+
+    def __init__(self):
+        self.fd = _get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+    def add_watch(self, path, mask):
+        """Watch `path`, returns False if it does not exist (yet)."""
+        wd = _get_libc().inotify_add_watch(self.fd, path.encode('utf-8'),
+                                           mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(code, os.strerror(code))
+        return True
+
+    def wait(self, timeout):
+        """Block the greenthread until an event arrives or `timeout`.
+
+        Pending events are drained, returns True if there were any.
+        """
+        readable, _w, _x = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
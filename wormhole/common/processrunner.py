@@ -0,0 +1,199 @@
+"""
+Persistent helper processes that run commands on behalf of the service.
+
+Forking the (large, many-fds) service process for every command is
+expensive: the whole address space is cloned and close_fds walks every
+possible descriptor. Instead, a small pool of long-lived helper processes
+receives command vectors over a pipe, forks them from their own tiny
+address space and sends the result back.
+"""
+
+import os
+import pickle
+import signal
+import struct
+import subprocess
+import sys
+
+from eventlet.green import subprocess as green_subprocess
+from eventlet import queue
+
+from wormhole.common.gettextutils import _, _LW
+from wormhole.common import log as logging
+from wormhole.common import processutils
+
+LOG = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+
+
+def _read_exact(read, size):
+    data = b''
+    while len(data) < size:
+        chunk = read(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _read_msg(read):
+    (size,) = _HEADER.unpack(_read_exact(read, _HEADER.size))
+    return pickle.loads(_read_exact(read, size))
+
+
+def _pack_msg(obj):
+    data = pickle.dumps(obj, 2)
+    return _HEADER.pack(len(data)) + data
+
+
+class HelperUnavailable(Exception):
+    """The helper went away before it received the command."""
+
+
+class HelperDied(Exception):
+    """The helper went away while running the command."""
+
+
+class _Helper(object):
+    """Client side of one helper process."""
+
+    def __init__(self):
+        self.proc = green_subprocess.Popen(
+            [sys.executable, '-m', 'wormhole.common.processrunner'],
+            stdin=green_subprocess.PIPE,
+            stdout=green_subprocess.PIPE,
+            close_fds=True)
+        LOG.debug("Started command helper pid %s", self.proc.pid)
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, cmd, process_input, env_variables, shell):
+        request = _pack_msg({'cmd': cmd, 'input': process_input,
+                             'env': env_variables, 'shell': shell})
+        try:
+            self.proc.stdin.write(request)
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            raise HelperUnavailable()
+        try:
+            response = _read_msg(self.proc.stdout.read)
+        except (EOFError, IOError, OSError):
+            raise HelperDied()
+        if 'error' in response:
+            raise OSError(response['errno'], response['error'])
+        return response['returncode'], (response['stdout'],
+                                        response['stderr'])
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+
+
+class ProcessRunner(object):
+    """A pool of at most `size` helpers, started on demand."""
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.LightQueue()
+        self._started = 0
+
+    def _acquire(self):
+        if self._idle.empty() and self._started < self.size:
+            self._started += 1
+            try:
+                return _Helper()
+            except Exception:
+                self._started -= 1
+                raise
+        return self._idle.get()
+
+    def _release(self, helper):
+        if helper.alive:
+            self._idle.put(helper)
+        else:
+            self._started -= 1
+
+    def run(self, cmd, process_input=None, env_variables=None, shell=False):
+        """Run `cmd` in a helper, returns (returncode, (stdout, stderr),
+        mode), mode being 'helper', or 'subprocess' once it fell back to
+        forking locally because no helper could take the command. A helper dying while a command is running is reported
+        as a ProcessExecutionError, since the command may already have
+        had side effects and must not be replayed.
+        """
+        try:
+            helper = self._acquire()
+        except (IOError, OSError) as e:
+            LOG.warn(_LW("Cannot start command helper, forking %(cmd)s "
+                         "directly: %(err)s"), {'cmd': cmd[0], 'err': e})
+            return processutils._popen_communicate(
+                cmd, process_input, env_variables, shell) + ('subprocess',)
+        try:
+            return helper.run(cmd, process_input, env_variables,
+                              shell) + ('helper',)
+        except HelperUnavailable:
+            helper.kill()
+            LOG.warn(_LW("Command helper %(pid)s is gone, forking %(cmd)s "
+                         "directly"), {'pid': helper.proc.pid, 'cmd': cmd[0]})
+            return processutils._popen_communicate(
+                cmd, process_input, env_variables, shell) + ('subprocess',)
+        except HelperDied:
+            helper.kill()
+            raise processutils.ProcessExecutionError(
+                cmd=' '.join(cmd),
+                description=_('Command helper died while running '
+                              'the command.'))
+        finally:
+            self._release(helper)
+
+
+_runner = None
+
+
+def get_runner(size):
+    global _runner
+    if _runner is None:
+        _runner = ProcessRunner(size)
+    return _runner
+
+
+def _subprocess_setup():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _serve():
+    """Helper process main loop."""
+    read = lambda size: os.read(0, size)
+    while True:
+        try:
+            request = _read_msg(read)
+        except EOFError:
+            return
+        try:
+            # Our own descriptors are only the two pipes to the service,
+            # which Popen replaces in the child, so skip the close_fds scan.
+            obj = subprocess.Popen(request['cmd'],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=False,
+                                   preexec_fn=_subprocess_setup,
+                                   shell=request['shell'],
+                                   env=request['env'])
+            stdout, stderr = obj.communicate(request['input'])
+            response = {'returncode': obj.returncode,
+                        'stdout': stdout, 'stderr': stderr}
+        except OSError as e:
+            response = {'errno': e.errno, 'error': e.strerror}
+        data = _pack_msg(response)
+        while data:
+            data = data[os.write(1, data):]
+
+
+if __name__ == '__main__':
+    _serve()
@@ -24,9 +24,12 @@ import os
 import random
 import shlex
 import signal
+import time
 
+from eventlet import corolocal
 from eventlet.green import subprocess
 from eventlet import greenthread
+from eventlet import hubs
 import six
 
 from gettextutils import _
@@ -80,6 +83,185 @@ def _subprocess_setup():
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 
+def _subprocess_setup_group():
+    _subprocess_setup()
+    os.setpgid(0, 0)
+
+
+class ProcessGroups(object):
+    """Process groups of the commands run on behalf of one job.
+
+    Once killed, commands started later are killed as soon as they are
+    forked, so a job can't outrun its cancellation.
+    """
+
+    def __init__(self):
+        self.pgids = set()
+        self.killed = False
+
+    def add(self, pgid):
+        self.pgids.add(pgid)
+        if self.killed:
+            self._killpg(pgid)
+
+    def discard(self, pgid):
+        self.pgids.discard(pgid)
+
+    def kill(self):
+        self.killed = True
+        for pgid in list(self.pgids):
+            self._killpg(pgid)
+
+    def _killpg(self, pgid):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                LOG.warn(_('Failed to kill process group %(pgid)s: %(err)s'),
+                         {'pgid': pgid, 'err': e})
+
+
+_tracking = corolocal.local()
+
+
+def track_process_groups(groups):
+    """Run the next commands of the current greenthread in their own
+    process group, registered in `groups` (a ProcessGroups) while they
+    run. None stops the tracking.
+    """
+    _tracking.groups = groups
+
+
+def _tracked_process_groups():
+    return getattr(_tracking, 'groups', None)
+
+
+def propagate_process_groups(func):
+    """Wrap `func`, to be run in another greenthread, so the commands it
+    runs are tracked like those of the calling greenthread.
+    """
+    groups = _tracked_process_groups()
+    if groups is None:
+        return func
+
+    def _tracked(*args, **kwargs):
+        track_process_groups(groups)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            track_process_groups(None)
+    return _tracked
+
+
+_latency_stats = {}
+
+
+def _record_latency(name, mode, elapsed):
+    stat = _latency_stats.setdefault((os.path.basename(name), mode),
+                                     {'count': 0, 'total': 0.0, 'max': 0.0})
+    stat['count'] += 1
+    stat['total'] += elapsed
+    stat['max'] = max(stat['max'], elapsed)
+
+
+def get_latency_stats():
+    """Return per-command execution latency counters.
+
+    One entry per (command, mode) pair, where mode is 'subprocess' for
+    commands forked from this process and 'helper' for commands run by a
+    persistent helper process.
+    """
+    return [{'command': name, 'mode': mode, 'count': stat['count'],
+             'total': stat['total'], 'max': stat['max'],
+             'avg': stat['total'] / stat['count']}
+            for (name, mode), stat in sorted(_latency_stats.items())]
+
+
+def _communicate_streaming(obj, process_input, stdout_callback):
+    """Like communicate(), also handing stdout to `stdout_callback` as
+    the command writes it. The command is killed if the callback raises.
+    """
+    if process_input is not None:
+        obj.stdin.write(process_input)
+    obj.stdin.close()
+    stderr = greenthread.spawn(obj.stderr.read)
+    stdout = []
+    fd = obj.stdout.fileno()
+    try:
+        while True:
+            hubs.trampoline(fd, read=True)
+            try:
+                data = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                break
+            stdout.append(data)
+            stdout_callback(data)
+    except Exception:
+        try:
+            obj.kill()
+        except OSError:
+            pass
+        obj.wait()
+        raise
+    obj.wait()
+    return ''.join(stdout), stderr.wait()
+
+
+def _popen_communicate(cmd, process_input, env_variables, shell,
+                       stdout_callback=None):
+    _PIPE = subprocess.PIPE  # pylint: disable=E1101
+
+    groups = _tracked_process_groups()
+    if os.name == 'nt':
+        preexec_fn = None
+        close_fds = False
+    elif groups is not None:
+        preexec_fn = _subprocess_setup_group
+        close_fds = True
+    else:
+        preexec_fn = _subprocess_setup
+        close_fds = True
+
+    obj = subprocess.Popen(cmd,
+                           stdin=_PIPE,
+                           stdout=_PIPE,
+                           stderr=_PIPE,
+                           close_fds=close_fds,
+                           preexec_fn=preexec_fn,
+                           shell=shell,
+                           env=env_variables)
+    if groups is not None:
+        groups.add(obj.pid)
+    result = None
+    try:
+        if stdout_callback is not None:
+            result = _communicate_streaming(obj, process_input,
+                                            stdout_callback)
+        else:
+            for _i in six.moves.range(20):
+                # NOTE(russellb) 20 is an arbitrary number of retries to
+                # prevent any chance of looping forever here.
+                try:
+                    if process_input is not None:
+                        result = obj.communicate(process_input)
+                    else:
+                        result = obj.communicate()
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+                break
+    finally:
+        if groups is not None:
+            groups.discard(obj.pid)
+    obj.stdin.close()  # pylint: disable=E1101
+    return obj.returncode, result  # pylint: disable=E1101
+
+
 def execute(*cmd, **kwargs):
     """Helper method to shell out and execute a command through subprocess.
 
@@ -114,6 +296,17 @@ def execute(*cmd, **kwargs):
     :type shell:            boolean
     :param loglevel:        log level for execute commands.
     :type loglevel:         int.  (Should be logging.DEBUG or logging.INFO)
+    :param runner:          object whose run(cmd, process_input,
+                            env_variables, shell) returns
+                            (returncode, (stdout, stderr), mode), mode
+                            being 'helper' or 'subprocess' as the command
+                            ran, used instead of
+                            forking the command from this process. Ignored
+                            while the greenthread tracks process groups.
+    :param stdout_callback: called with each chunk of stdout as the
+                            command writes it, e.g. to follow its
+                            progress. The command is forked locally and
+                            killed if the callback raises.
     :returns:               (stdout, stderr) from process execution
     :raises:                :class:`UnknownArgumentError` on
                             receiving unknown arguments
@@ -130,6 +323,12 @@ def execute(*cmd, **kwargs):
     root_helper = kwargs.pop('root_helper', '')
     shell = kwargs.pop('shell', False)
     loglevel = kwargs.pop('loglevel', logging.DEBUG)
+    runner = kwargs.pop('runner', None)
+    stdout_callback = kwargs.pop('stdout_callback', None)
+    if _tracked_process_groups() is not None or stdout_callback is not None:
+        # the process group of a helper's child is unknown here, fork
+        # locally so the command can be killed
+        runner = None
 
     if isinstance(check_exit_code, bool):
         ignore_exit_code = not check_exit_code
@@ -149,44 +348,22 @@ def execute(*cmd, **kwargs):
 
     cmd = map(str, cmd)
     sanitized_cmd = strutils.mask_password(' '.join(cmd))
+    mode = 'helper' if runner is not None else 'subprocess'
 
     while attempts > 0:
         attempts -= 1
         try:
-            LOG.log(loglevel, _('Running cmd (subprocess): %s'), sanitized_cmd)
-            _PIPE = subprocess.PIPE  # pylint: disable=E1101
-
-            if os.name == 'nt':
-                preexec_fn = None
-                close_fds = False
+            LOG.log(loglevel, _('Running cmd (%(mode)s): %(cmd)s'),
+                    {'mode': mode, 'cmd': sanitized_cmd})
+            start = time.time()
+            if runner is not None:
+                _returncode, result, mode = runner.run(cmd, process_input,
+                                                       env_variables, shell)
             else:
-                preexec_fn = _subprocess_setup
-                close_fds = True
-
-            obj = subprocess.Popen(cmd,
-                                   stdin=_PIPE,
-                                   stdout=_PIPE,
-                                   stderr=_PIPE,
-                                   close_fds=close_fds,
-                                   preexec_fn=preexec_fn,
-                                   shell=shell,
-                                   env=env_variables)
-            result = None
-            for _i in six.moves.range(20):
-                # NOTE(russellb) 20 is an arbitrary number of retries to
-                # prevent any chance of looping forever here.
-                try:
-                    if process_input is not None:
-                        result = obj.communicate(process_input)
-                    else:
-                        result = obj.communicate()
-                except OSError as e:
-                    if e.errno in (errno.EAGAIN, errno.EINTR):
-                        continue
-                    raise
-                break
-            obj.stdin.close()  # pylint: disable=E1101
-            _returncode = obj.returncode  # pylint: disable=E1101
+                _returncode, result = _popen_communicate(cmd, process_input,
+                                                         env_variables, shell,
+                                                         stdout_callback)
+            _record_latency(cmd[0], mode, time.time() - start)
             LOG.log(loglevel, 'Result was %s' % _returncode)
             LOG.log(loglevel, 'stdout/stderr output was %s' % repr(result))
             if not ignore_exit_code and _returncode not in check_exit_code:
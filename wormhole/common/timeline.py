@@ -0,0 +1,97 @@
+"""
+Boot timeline shared by the boot scripts and the service.
+
+Both sides append one JSON record per phase start or end to the same file:
+
+  {"source": "script", "phase": "disk_scan", "event": "start",
+   "uptime": 12.31, "time": 1444444444.12}
+
+`uptime` comes from /proc/uptime on both sides, so the stamps of the
+scripts and of the service are monotonic and comparable. The boot script
+truncates the file when a boot starts (see timeline() in bin/env).
+"""
+
+import contextlib
+import os
+import time
+
+from oslo.config import cfg
+
+from wormhole.common import jsonutils
+from wormhole.common import log as logging
+
+timeline_opts = [
+    cfg.StrOpt('boot_timeline_file',
+               default='/var/lib/wormhole/boot-timeline.jsonl',
+               help='File the boot phases are recorded in, shared with '
+                    'the boot scripts.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(timeline_opts)
+
+LOG = logging.getLogger(__name__)
+
+
+def uptime():
+    with open('/proc/uptime') as f:
+        return float(f.read().split()[0])
+
+
+def record(phase, event, **extra):
+    """Append a `phase` start/end record, never failing the caller."""
+    entry = {'source': 'service', 'phase': phase, 'event': event,
+             'pid': os.getpid()}
+    entry.update(extra)
+    try:
+        entry['uptime'] = uptime()
+        entry['time'] = time.time()
+        with open(CONF.boot_timeline_file, 'a') as f:
+            f.write(jsonutils.dumps(entry) + '\n')
+    except (IOError, OSError) as e:
+        LOG.debug("Can't record boot phase %s %s: %s", phase, event, e)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the start and the end of the enclosed block as `name`."""
+    record(name, 'start')
+    try:
+        yield
+    except Exception:
+        record(name, 'end', status='error')
+        raise
+    record(name, 'end', status='ok')
+
+
+def read():
+    """The records, and the phases they make, in start order.
+
+    Phases are [{'source', 'phase', 'start', 'end', 'duration', 'status'}]
+    in uptime seconds; end and duration are None while a phase runs.
+    """
+    events = []
+    if os.path.exists(CONF.boot_timeline_file):
+        with open(CONF.boot_timeline_file) as f:
+            for line in f:
+                try:
+                    events.append(jsonutils.loads(line))
+                except ValueError:
+                    continue
+    phases = []
+    running = {}
+    for event in events:
+        key = (event.get('source'), event.get('phase'))
+        if event.get('event') == 'start':
+            running[key] = {'source': key[0], 'phase': key[1],
+                            'start': event.get('uptime'), 'end': None,
+                            'duration': None, 'status': None}
+            phases.append(running[key])
+        elif event.get('event') == 'end' and key in running:
+            current = running.pop(key)
+            current['end'] = event.get('uptime')
+            current['status'] = event.get('status')
+            if current['start'] is not None and current['end'] is not None:
+                current['duration'] = round(current['end'] -
+                                            current['start'], 3)
+    return {'events': events, 'phases': phases}
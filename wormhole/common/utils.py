@@ -1,13 +1,24 @@
 """Utilities and helper functions."""
 
 import math
+import os
 import crypt
 import random
 import re
+import sys
+import time
+
+import eventlet
+import eventlet.event
+from eventlet import tpool
+import six
 
 from wormhole import exception
 from wormhole.i18n import _
+from wormhole.common import blockcopy
+from wormhole.common import blockdev
 from wormhole.common import jsonutils
+from wormhole.common import processrunner
 from wormhole.common import processutils
 from wormhole.common import excutils
 from wormhole.common import strutils
@@ -23,6 +34,23 @@ utils_opt = [
     cfg.BoolOpt('fake_execute',
                 default=False,
                 help='If passed, use fake network devices and addresses'),
+    cfg.IntOpt('execute_helpers',
+               default=0,
+               help='Number of persistent helper processes used to run '
+                    'commands instead of forking the service for each of '
+                    'them. 0 disables the helpers.'),
+    cfg.BoolOpt('volume_copy_native',
+                default=True,
+                help='Copy volumes in-process, skipping holes and zeroed '
+                     'blocks, instead of running dd over the whole size.'),
+    cfg.IntOpt('volume_copy_workers',
+               default=4,
+               help='Number of ranges of a volume copied concurrently by '
+                    'the native volume copy.'),
+    cfg.IntOpt('volume_copy_range_size',
+               default=64,
+               help='Size in MB of the ranges a native volume copy is '
+                    'split into.'),
 ]
 
 CONF.register_opts(utils_opt)
@@ -55,6 +83,67 @@ class UndoManager(object):
 
             self._rollback()
 
+def green_map(func, items, size):
+    """Call func on every item on a GreenPool bounded to `size`.
+
+    Returns the results in the order of `items`. Every call is allowed to
+    finish before the first exception raised by any of them is re-raised,
+    so callers never roll back while work is still in flight. Commands
+    run by `func` are tracked like the caller's, so cancelling a task
+    kills them too.
+    """
+    func = processutils.propagate_process_groups(func)
+    pool = eventlet.GreenPool(max(1, size))
+    threads = [pool.spawn(func, item) for item in items]
+    results = []
+    exc_info = None
+    for gt in threads:
+        try:
+            results.append(gt.wait())
+        except Exception:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+            results.append(None)
+    if exc_info is not None:
+        six.reraise(*exc_info)
+    return results
+
+def run_steps(steps):
+    """Run (name, func, deps) steps as a dependency graph.
+
+    Every step runs in its own greenthread as soon as the steps named in
+    its deps have succeeded; a step whose dependency failed is skipped.
+    Once everything has settled the first error is re-raised, otherwise
+    the timings are returned in start order:
+    [{'step': name, 'start': offset, 'duration': seconds}, ...], offsets
+    counted from the call.
+    """
+    done = dict((name, eventlet.event.Event()) for name, _f, _d in steps)
+    timings = []
+    started_at = time.time()
+
+    def _run(step):
+        name, func, deps = step
+        if not all([done[dep].wait() for dep in deps]):
+            LOG.debug("Skip step %s, a dependency failed", name)
+            done[name].send(False)
+            return
+        start = time.time()
+        timing = {'step': name, 'start': round(start - started_at, 3)}
+        timings.append(timing)
+        try:
+            func()
+        except Exception:
+            done[name].send(False)
+            raise
+        else:
+            done[name].send(True)
+        finally:
+            timing['duration'] = round(time.time() - start, 3)
+
+    green_map(_run, steps, len(steps))
+    return timings
+
 class SmarterEncoder(jsonutils.json.JSONEncoder):
     """Help for JSON encoding dict-like objects."""
     def default(self, obj):
@@ -80,6 +169,12 @@ def get_root_helper():
     # return 'sudo wormhole-api %s' % CONF.rootwrap_config
 
 
+def _set_runner(kwargs):
+    if CONF.execute_helpers > 0 and not kwargs.get('shell'):
+        kwargs.setdefault('runner',
+                          processrunner.get_runner(CONF.execute_helpers))
+
+
 def execute(*cmd, **kwargs):
     """Convenience wrapper around oslo's execute() method."""
     if 'run_as_root' in kwargs and 'root_helper' not in kwargs:
@@ -89,9 +184,11 @@ def execute(*cmd, **kwargs):
         LOG.debug('FAKE EXECUTE: %s', ' '.join(map(str, cmd)))
         return 'fake', 0
     else:
+        _set_runner(kwargs)
         return processutils.execute(*cmd, **kwargs)
 
 def trycmd(*cmd, **kwargs):
+    _set_runner(kwargs)
     return processutils.trycmd(*cmd, **kwargs)
 
 
@@ -131,7 +228,7 @@ def check_for_odirect_support(src, dest, flag='oflag=direct'):
         return False
 
 
-def copy_volume(srcstr, deststr, size_in_m, blocksize, sync=False, ionice=None):
+def _dd_copy(srcstr, deststr, size_in_m, blocksize, sync, ionice):
     # Use O_DIRECT to avoid thrashing the system buffer cache
     extra_flags = []
     if check_for_odirect_support(srcstr, deststr, 'iflag=direct'):
@@ -155,10 +252,74 @@ def copy_volume(srcstr, deststr, size_in_m, blocksize, sync=False, ionice=None):
     if ionice is not None:
         cmd = ['ionice', ionice] + cmd
 
+    execute(*cmd, run_as_root=True)
 
+
+def _native_copy(srcstr, deststr, size_in_m, blocksize, sync, progress,
+                 checkpoint):
+    blocksize, _count = _calculate_count(size_in_m, blocksize)
+    chunk_size = strutils.string_to_bytes('%sB' % blocksize)
+    size = size_in_m * units.Mi
+    if checkpoint is not None:
+        range_size = checkpoint.range_size
+    else:
+        range_size = max(1, CONF.volume_copy_range_size) * units.Mi
+    ranges = []
+    for index, start in enumerate(six.moves.range(0, size, range_size)):
+        end = min(start + range_size, size)
+        if checkpoint is not None and checkpoint.is_done(index):
+            if progress:
+                progress(end - start)
+            continue
+        ranges.append((index, start, end))
+
+    copier = blockcopy.VolumeCopier(srcstr, deststr, size, chunk_size)
+
+    def _copy_range(item):
+        index, start, end = item
+        # the copy loops block in read/write, keep them off the hub
+        result = tpool.execute(copier.copy_range, start, end, progress)
+        if checkpoint is not None:
+            # only record ranges which would survive a host crash
+            tpool.execute(copier.sync)
+            checkpoint.mark_done(index)
+        return result
+
+    tpool.execute(copier.open)
+    LOG.debug("Copy %(src)s to %(dst)s, direct io: %(direct)s",
+              {'src': srcstr, 'dst': deststr, 'direct': copier.direct})
+    try:
+        results = green_map(_copy_range, ranges, CONF.volume_copy_workers)
+        tpool.execute(copier.close, sync=sync)
+    finally:
+        tpool.execute(copier.close)
+    copied = sum(r[0] for r in results)
+    zeroed = sum(r[1] for r in results)
+    LOG.debug("Volume copy of %(dest)s: %(copied)d bytes copied, "
+              "%(zeroed)d bytes of holes or zeroes skipped, %(resumed)d "
+              "ranges already done",
+              {'dest': deststr, 'copied': copied, 'zeroed': zeroed,
+               'resumed': (size + range_size - 1) // range_size - len(ranges)})
+
+
+def copy_volume(srcstr, deststr, size_in_m, blocksize, sync=False, ionice=None,
+                progress=None, checkpoint=None):
+    """Copy size_in_m MB from srcstr to deststr.
+
+    `progress`, if given, is called with the number of bytes handled as
+    the native copy goes. `checkpoint`, if given, records the ranges
+    already copied (range_size, is_done(index), mark_done(index)) so an
+    interrupted native copy can be resumed with it.
+    """
     # Perform the copy
     start_time = timeutils.utcnow()
-    execute(*cmd, run_as_root=True)
+    if CONF.volume_copy_native and ionice is None:
+        _native_copy(srcstr, deststr, size_in_m, blocksize, sync, progress,
+                     checkpoint)
+    else:
+        _dd_copy(srcstr, deststr, size_in_m, blocksize, sync, ionice)
+        if progress:
+            progress(size_in_m * units.Mi)
     duration = timeutils.delta_seconds(start_time, timeutils.utcnow())
 
     # NOTE(jdg): use a default of 1, mostly for unit test, but in
@@ -244,22 +405,24 @@ def set_passwd(username, admin_passwd, passwd_data, shadow_data):
     return "\n".join(new_shadow)
 
 DEVICE_RE = re.compile(r'^x?[a-z]?d?[a-z]$')
-def list_device():
+def list_device(snapshot=None):
     """
     Example returns:
       [
         { "name": "/dev/sde", "type": "disk", "size": "3G", "maj:min": "8:16" },
         { "name": "/dev/sdh", "type": "disk", "size": "4G", "maj:min": "8:48" }
       ]
+
+    Devices come from `snapshot` (a blockdev.DeviceSnapshot) if given,
+    else from the uevent driven index, else straight from sysfs.
     """
     filter_fields = ['name', 'type', 'maj:min', 'size']
-    dev_out, _err = trycmd('lsblk', '-dn', '-o', ','.join(filter_fields))
+    if snapshot is None:
+        snapshot = blockdev.snapshot()
     dev_list = []
-    for dev in dev_out.strip().split('\n'):
-        res = dev.split()
-        name, disk_type = res[:2]
-        if disk_type == 'disk' and not name.endswith('da') and DEVICE_RE.match(name):
-            res[0] = "/dev/" + name
-            dev_list.append(dict(zip(filter_fields, res)))
-    LOG.debug("scan host devices: %s", dev_list)
+    for dev in snapshot.list():
+        name = os.path.basename(dev['name'])
+        if not name.endswith('da') and DEVICE_RE.match(name):
+            dev_list.append(dict((k, dev[k]) for k in filter_fields))
+    LOG.debug("host devices: %s", dev_list)
     return dev_list
@@ -3,24 +3,29 @@ import webob
 from wormhole import exception
 from wormhole import wsgi
 
+from wormhole.common import blockdev
 from wormhole.common import log
 from wormhole.common import importutils
+from wormhole.common import timeline
 from wormhole.common import utils
 from wormhole.i18n import _
+from wormhole import liblxc_client
 from wormhole.lxc_client import LXCClient
 from wormhole.net_util import network
+from wormhole.settings_store import SettingsStore
+from wormhole.state_cache import ContainerStateCache
 
-from wormhole.tasks import addtask
+from wormhole.tasks import addtask, PRIORITY_HIGH, PRIORITY_LOW
 from wormhole.tasks import FAKE_SUCCESS_TASK, FAKE_ERROR_TASK
 
 from wormhole.state import *
 
+import functools
 import six
 import os
 import base64
-import json
+import tarfile
 
-import time
 import sys, traceback
 
 from oslo.config import cfg
@@ -31,11 +36,14 @@ container_opts = [
         help='The dir containing symbolic files named volume-id targeting device path.'),
     cfg.StrOpt('container_driver',
         default="lxc",
-        help='The container manager'),
+        help='The container manager: "lxc" runs the lxc command line '
+             'tools, "liblxc" uses the in-process liblxc python binding '
+             'when it is installed and falls back to the tools otherwise.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(container_opts)
+CONF.import_opt('vif_concurrency', 'wormhole.net_util.vifs')
 
 LOG = log.getLogger(__name__)
 
@@ -48,27 +56,40 @@ def container_root_path():
     CONTAINER_LINK_NAME = "data-device-link"
     return volume_link_path(CONTAINER_LINK_NAME)
 
-def check_dev_exist(dev_path):
-    """ check /dev/sde exists by `fdisk'. Note `lsblk' can't guarentee that. """
-    disk_info, _ignore_err = utils.trycmd('fdisk', '-l', dev_path)
-    return disk_info.strip() != ''
-
-def load_settings():
-    return json.load(open(WORMHOLE_SETTING_FILE))
-
-def save_settings(settings):
-    with open(WORMHOLE_SETTING_FILE, 'w') as f:
-        f.write(json.dumps(settings))
+def check_dev_exist(dev_path, snapshot=None):
+    """ check /dev/sde exists, i.e. the kernel lists it with a capacity in
+    /proc/partitions (what `fdisk -l' relies on). Note `lsblk' can't
+    guarentee that. Pass a blockdev.DeviceSnapshot to check many devices
+    against one read. """
+    if snapshot is None:
+        snapshot = blockdev.DeviceSnapshot(devices=[])
+    return snapshot.exists(dev_path)
+
+def get_container_client():
+    if CONF.container_driver == 'liblxc':
+        if liblxc_client.is_available():
+            return liblxc_client.LiblxcClient()
+        LOG.warn(_("liblxc python binding is not available, "
+                   "use the lxc command line tools"))
+    return LXCClient()
 
 class ContainerController(wsgi.Application):
 
     def __init__(self):
         self._manager = None
+        self._state_cache = None
         self._container = None
         self._ns_created = False
         vif_class = importutils.import_class(CONF.lxc.vif_driver)
         self.vif_driver = vif_class()
-        self._settings = None
+        self._settings = SettingsStore(WORMHOLE_SETTING_FILE)
+        try:
+            # folds what the last run journaled into the snapshot the
+            # boot scripts read
+            self._settings.load()
+        except Exception as e:
+            LOG.warn(_("Failed to load settings %s: %s"),
+                     WORMHOLE_SETTING_FILE, e)
         self._setup_volume_mapping()
         super(ContainerController, self).__init__()
 
@@ -101,27 +122,36 @@ class ContainerController(wsgi.Application):
                 _found_dev.add(n.strip(':').split('@')[0])
         return _found_dev
 
-    def _available_eth_name(self):
+    def _available_eth_names(self, count):
+        """ Allocate `count' free ethN names with a single discovery. """
         net_prefix = 'eth'
         used_eths = self._discovery_use_eth()
+        names = []
         i = 0
-        while 1:
+        while len(names) < count:
             name = net_prefix + str(i)
             if name not in used_eths:
                 LOG.debug(_("Available net name ==> %s"), name)
-                return name
+                names.append(name)
             i += 1
+        return names
 
     @property
     def manager(self):
         if self._manager is None:
-            self._manager = LXCClient()
+            self._manager = get_container_client()
         return self._manager
 
+    @property
+    def state_cache(self):
+        if self._state_cache is None:
+            self._state_cache = ContainerStateCache(self.manager)
+        return self._state_cache
+
     @property
     def container(self):
         if self._container is None:
-            containers = self.manager.list(all=True)
+            containers = self.state_cache.list()
             if not containers:
                 raise exception.ContainerNotFound()
             if len(containers) > 1:
@@ -151,14 +181,16 @@ class ContainerController(wsgi.Application):
                 volume_id = bdm['connection_info']['data']['volume_id']
                 new_volume_mapping[volume_id] = {"mount_device" : mount_device, "size": str(size_in_g) + "G"}
 
-            all_devices = utils.list_device()
+            # one read of sysfs and /proc/partitions for all the volumes
+            devices = blockdev.snapshot()
+            all_devices = utils.list_device(devices)
             to_remove_volumes = set(self._volume_mapping) - set(new_volume_mapping)
 
             for comm_volume in set(self._volume_mapping).intersection(new_volume_mapping):
                 _path = self._volume_mapping[comm_volume]
                 _size = new_volume_mapping[comm_volume]['size']
                 # If the device not exist or size not match, then remove it.
-                if not check_dev_exist(_path) or \
+                if not check_dev_exist(_path, devices) or \
                         any([d['name'] == _path and d['size'] == _size for d in all_devices]):
                     LOG.info(_("Volume %s doesn't match, update it."), comm_volume)
                     to_remove_volumes.add(comm_volume)
@@ -189,33 +221,24 @@ class ContainerController(wsgi.Application):
     def plug_vifs(self, network_info):
         """Plug VIFs into networks."""
         instance = self.container['id']
-        for vif in network_info:
-            LOG.debug(_("Plug vif %s"), vif)
-            self.vif_driver.plug(vif, instance)
+        LOG.debug(_("Plug vifs %s"), network_info)
+        self.vif_driver.plug_vifs(network_info, instance)
 
     def _find_container_pid(self, container_id):
-        n = 0
-        while True:
-            # NOTE(samalba): We wait for the process to be spawned inside the
-            # container in order to get the the "container pid". This is
-            # usually really fast. To avoid race conditions on a slow
-            # machine, we allow 10 seconds as a hard limit.
-            if n > 20:
-                return
-            info = self.manager.inspect_container(container_id)
-            if info:
-                pid = info['State']['Pid']
-                # Pid is equal to zero if it isn't assigned yet
-                if pid:
-                    return pid
-            time.sleep(0.5)
-            n += 1
+        # NOTE(samalba): We wait for the process to be spawned inside the
+        # container in order to get the the "container pid". This is
+        # usually really fast. To avoid race conditions on a slow
+        # machine, we allow 10 seconds as a hard limit.
+        return self.manager.wait_for_pid(container_id, timeout=10)
+
+    def _prepare_ns(self):
+        if not os.path.exists('/var/run/netns'):
+            utils.execute('mkdir', '-p', '/var/run/netns', run_as_root=True)
 
     def _create_ns(self):
         container_id = self.container['id']
         netns_path = '/var/run/netns'
-        if not os.path.exists(netns_path):
-            utils.execute('mkdir', '-p', netns_path, run_as_root=True)
+        self._prepare_ns()
         nspid = self._find_container_pid(container_id)
         if not nspid:
             msg = _('Cannot find any PID under container "{0}"')
@@ -228,15 +251,28 @@ class ContainerController(wsgi.Application):
         self._ns_created = True
 
     def _attach_vifs(self, network_info):
-        """Plug VIFs into container."""
+        """Attach the plugged VIFs to the container, returns their names."""
         if not network_info:
-            return
+            return []
         container_id = self.container['id']
         instance = container_id
+        new_remote_names = self._available_eth_names(len(network_info))
 
-        for idx, vif in enumerate(network_info):
-            new_remote_name = self._available_eth_name()
-            self.vif_driver.attach(vif, instance, container_id, new_remote_name)
+        def _attach_vif(args):
+            vif, new_remote_name = args
+            undo_mgr = utils.UndoManager()
+            try:
+                undo_mgr.undo_with(functools.partial(self.vif_driver.detach,
+                                                     vif, instance))
+                self.vif_driver.attach(vif, instance, container_id,
+                                       new_remote_name, reraise=True)
+            except Exception:
+                msg = _("Failed to attach vif %s, rolling back") % vif['id']
+                undo_mgr.rollback_and_reraise(msg=msg)
+
+        utils.green_map(_attach_vif, zip(network_info, new_remote_names),
+                        CONF.vif_concurrency)
+        return new_remote_names
 
     def _get_repository(self, image_name):
 
@@ -273,8 +309,10 @@ class ContainerController(wsgi.Application):
 
             def _do_create_after_download_image(name):
                 LOG.debug(_("Create container from image %s"), name)
-                self.manager.create_container(name, network_disabled=True)
-                _do_create()
+                with timeline.phase('container_create'):
+                    self.manager.create_container(name, network_disabled=True)
+                    self.state_cache.refresh()
+                    _do_create()
 
             if self.manager.images(name=local_image_name):
                 LOG.debug(_("Repository = %s already exists"), local_image_name)
@@ -290,7 +328,8 @@ class ContainerController(wsgi.Application):
                         if m:
                             utils.execute('ping', '-W', '3', '-c', '1', m.group())
                         LOG.debug(_("Starting pull image repository=%s:%s"), repository, image_id)
-                        resp = self.manager.pull(repository, tag=image_id, insecure_registry=True)
+                        with timeline.phase('image_pull'):
+                            resp = self.manager.pull(repository, tag=image_id, insecure_registry=True)
                         LOG.debug(_("Done pull image repository=%s:%s, resp %s"), repository, image_id, resp)
                         if any(resp.find(s)!=-1 for s in ['"error":', image_name + " not found"]):
                             LOG.warn(_("Can't pull image, use the local image with name=%s"), image_name)
@@ -299,16 +338,25 @@ class ContainerController(wsgi.Application):
                         name = image_name
                         LOG.exception(e)
                     _do_create_after_download_image(name)
-                task = addtask(_do_pull_image)
+                task = addtask(_do_pull_image, kind='create',
+                               priority=PRIORITY_HIGH)
                 LOG.debug(_("Pull image task %s"), task)
                 return task
 
     def start(self, request, network_info={}, block_device_info={}):
-        """ Start the container. """
+        """ Start the container.
+
+        Volume config, VIF plugging and netns preparation run
+        concurrently, lxc-start waits for all of them. Returns how long
+        each step took.
+        """
         container_id = self.container['id']
         LOG.info(_("Start container %s network_info %s block_device_info %s"),
                    container_id, network_info, block_device_info)
-        if block_device_info:
+
+        def _volumes():
+            if not block_device_info:
+                return
             try:
                 self._update_bdm(block_device_info)
             except Exception as e:
@@ -319,9 +367,11 @@ class ContainerController(wsgi.Application):
                 mount_device = bdm['mount_device']
                 volume_id = bdm['connection_info']['data']['volume_id']
                 real_device = bdm.get('real_device', self._volume_mapping[volume_id])
-                self.manager.attach_volume(self.container['id'], real_device, mount_device, static=True)
+                self.manager.attach_volume(container_id, real_device, mount_device, static=True)
 
-        if network_info:
+        def _vifs():
+            if not network_info:
+                return
             try:
                 self.plug_vifs(network_info)
             except Exception as e:
@@ -331,10 +381,33 @@ class ContainerController(wsgi.Application):
                 )
                 LOG.debug(msg, exc_info=True)
                 raise exception.ContainerStartFailed(msg)
-        self.manager.start(container_id, network_info=network_info)
-        self._create_ns()
-        self._settings = {"network_info": network_info, "block_device_info": block_device_info}
-        save_settings(self._settings)
+
+        def _lxc_start():
+            self.manager.start(container_id, network_info=network_info)
+            self.state_cache.refresh()
+
+        def _save_settings():
+            self._settings.set('network_info', network_info)
+            self._settings.set('block_device_info', block_device_info)
+
+        with timeline.phase('container_start'):
+            timings = utils.run_steps([
+                ('volumes', _volumes, []),
+                ('vifs', _vifs, []),
+                ('netns_dir', self._prepare_ns, []),
+                ('lxc_start', _lxc_start, ['volumes', 'vifs', 'netns_dir']),
+                ('netns', self._create_ns, ['lxc_start']),
+                ('settings', _save_settings, ['netns']),
+            ])
+        LOG.info(_("Started container %s: %s"), container_id, timings)
+        return {"steps": timings}
+
+    def _refresh_state(self):
+        # called from finally blocks, must not hide the error being raised
+        try:
+            self.state_cache.refresh()
+        except Exception as e:
+            LOG.warn(_("Failed to refresh container state: %s"), e)
 
     def _stop(self, container_id, timeout=5):
 
@@ -344,6 +417,8 @@ class ContainerController(wsgi.Application):
         except Exception as e:
             self.manager.unpause(container_id)
             self.manager.stop(container_id, timeout)
+        finally:
+            self._refresh_state()
         self._ns_created = False
         self._container = None
         return msg
@@ -380,8 +455,7 @@ class ContainerController(wsgi.Application):
     def unplug_vifs(self, network_info):
         """Unplug VIFs from networks."""
         instance = self.container['id']
-        for vif in network_info:
-            self.vif_driver.unplug(instance, vif)
+        self.vif_driver.unplug_vifs(instance, network_info)
 
     def restart(self, request, network_info={}, block_device_info={}):
         """ Restart the container. """
@@ -414,24 +488,10 @@ class ContainerController(wsgi.Application):
         if not vif:
             return
 
-        if self._settings is None:
-            self._settings = load_settings()
-        net_info = self._settings.setdefault('network_info', [])
-
-        idx = -1
-        for i in range(len(net_info)):
-            if net_info[i]['id'] == vif['id']:
-                idx = i
-                break
         if action == 'add':
-            if idx == -1:
-                net_info.append(vif)
-            else:
-                net_info[idx] = vif
-            save_settings(self._settings)
-        elif action == 'del' and idx >= 0:
-            net_info.pop(idx)
-            save_settings(self._settings)
+            self._settings.put_item('network_info', vif)
+        elif action == 'del':
+            self._settings.remove_item('network_info', vif['id'])
 
 
     def detach_interface(self, request, vif):
@@ -450,9 +510,8 @@ class ContainerController(wsgi.Application):
             LOG.debug(_("Attach network info %s"), vif)
             instance = container_id = self.container['id']
             self.vif_driver.plug(vif, instance)
-            new_remote_name = self._available_eth_name()
-            self.vif_driver.attach(vif, instance, container_id, new_remote_name)
-            self.manager.add_interfaces(container_id, [vif], net_names=[new_remote_name])
+            new_remote_names = self._attach_vifs([vif])
+            self.manager.add_interfaces(container_id, [vif], net_names=new_remote_names)
             self._save_interface(vif, action='add')
         return webob.Response(status_int=200)
 
@@ -481,8 +540,51 @@ class ContainerController(wsgi.Application):
             LOG.exception(e)
             raise exception.InjectFailed(path='', reason=repr(e) + str(e.message))
 
-    def inject_files(self, request, inject_files):
-        self._inject_files(inject_files, plain=True)
+    def _inject_files_stream(self, request):
+        """ Inject the files of a tar or multipart/form-data body.
+
+        Tar members are injected at their path in the archive, multipart
+        file fields at their field name. Both are copied straight from
+        the request, so memory doesn't grow with the payload.
+        """
+        container_id = self.container['id']
+        path = ''
+        try:
+            if request.content_type == 'multipart/form-data':
+                # webob spools the parts to temporary files
+                for path, field in request.POST.items():
+                    if getattr(field, 'file', None) is None:
+                        continue
+                    LOG.debug(_("Inject file %s from form data"), path)
+                    self.manager.inject_file_stream(container_id, path,
+                                                    field.file)
+            else:
+                tar = tarfile.open(fileobj=request.body_file, mode='r|*')
+                for member in tar:
+                    path = os.path.normpath('/' + member.name)
+                    if not member.isfile():
+                        if not member.isdir():
+                            LOG.warn(_("Skip injecting %s, not a regular "
+                                       "file"), path)
+                        continue
+                    LOG.debug(_("Inject file %s from tar, len = %d"), path,
+                              member.size)
+                    self.manager.inject_file_stream(container_id, path,
+                                                    tar.extractfile(member),
+                                                    mode=member.mode)
+        except (tarfile.TarError, exception.InvalidInput) as e:
+            LOG.exception(e)
+            raise exception.InjectFailed(path=path, reason=str(e))
+        except Exception as e:
+            LOG.exception(e)
+            raise exception.InjectFailed(path=path, reason=repr(e) + str(e.message))
+
+    def inject_files(self, request, inject_files=None):
+        if inject_files is None and \
+                request.content_type in wsgi.STREAMING_CONTENT_TYPES:
+            self._inject_files_stream(request)
+        else:
+            self._inject_files(inject_files or [], plain=True)
         return webob.Response(status_int=200)
 
 
@@ -572,15 +674,22 @@ class ContainerController(wsgi.Application):
                 tag=image_id)
             self.manager.push(repository, tag=image_id, insecure_registry=True)
             LOG.debug(_("Doing image %s"), repository)
-        task = addtask(_create_image_cb)
+        task = addtask(_create_image_cb, kind='image', priority=PRIORITY_LOW,
+                       fingerprint=('create_image', image_id))
         LOG.debug(_("Created image task %s"), task)
         return task
 
     def pause(self, request):
-        self.manager.pause(self.container['id'])
+        try:
+            self.manager.pause(self.container['id'])
+        finally:
+            self._refresh_state()
 
     def unpause(self, request):
-        self.manager.unpause(self.container['id'])
+        try:
+            self.manager.unpause(self.container['id'])
+        finally:
+            self._refresh_state()
 
     def console_output(self, request):
         return { "logs": self.manager.logs(self.container['id']) }
@@ -589,7 +698,7 @@ class ContainerController(wsgi.Application):
         try:
             images = self.manager.images()
             if images:
-                containers = self.manager.list(all=True)
+                containers = self.state_cache.list()
                 if containers:
                     status = containers[0]['status']
                     code = ([k for k in STATE_MAP if STATE_MAP[k] == status.upper()]
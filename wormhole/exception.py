@@ -134,6 +134,9 @@ class TaskNotFound(NotFound):
     title = "Task Not Found"
     msg_fmt = _("Task %(id)s Not Found.")
 
+class TaskCancelled(WormholeException):
+    msg_fmt = _("Task %(id)s was stopped.")
+
 class DirNotFound(NotFound):
     title = "Dir Not Found"
     msg_fmt = _("Dir %(dir)s Not Found.")
@@ -151,6 +154,9 @@ class ContainerStartFailed(WormholeException):
 class InjectFailed(WormholeException):
     msg_fmt = _("Inject file %(path)s failed: %(reason)s")
 
+class ImageLoadFailed(WormholeException):
+    msg_fmt = _("Unable to load image %(path)s: %(reason)s")
+
 class ContainerManagerNotFound(WormholeException):
     msg_fmt = _("Container mangager daemon not started")
     
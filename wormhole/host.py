@@ -1,8 +1,14 @@
 import webob
 from wormhole import exception
 from wormhole import wsgi
+from wormhole.common import blockdev
+from wormhole.common import imageutils
 from wormhole.common import utils
 from wormhole.common import log
+from wormhole.common import processutils
+from wormhole.common import timeline
+from wormhole.i18n import _
+from wormhole.tasks import addtask, Progress, PRIORITY_HIGH
 from oslo.utils import importutils
 
 import base64
@@ -11,7 +17,23 @@ LOG = log.getLogger(__name__)
 
 import os
 from oslo.config import cfg
+
+host_opts = [
+    cfg.StrOpt('image_file',
+               default='/var/lib/wormhole/user.img',
+               help='Image downloaded for the first boot.'),
+    cfg.StrOpt('image_downloaded_flag',
+               default='/var/lib/wormhole/.lxc_image_downloaded',
+               help='File created once image_file is completely '
+                    'downloaded.'),
+    cfg.StrOpt('image_converted_flag',
+               default='/var/lib/wormhole/.lxc_image_converted',
+               help='File created once image_file is written onto the '
+                    'data device.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(host_opts)
 
 class HostController(wsgi.Application):
 
@@ -34,6 +56,42 @@ class HostController(wsgi.Application):
             raise exception.InjectFailed(path=dst_path)
         return webob.Response(status_int=204)
 
+    def exec_stats(self, request):
+        """ Per-command execution latency counters. """
+        return {"exec_stats": processutils.get_latency_stats()}
+
+    def load_image(self, request, device):
+        """ Write the downloaded image onto `device`, returns the task.
+
+        The image is copied while it is still being downloaded when its
+        format allows it; the task reports the progress.
+        """
+        if blockdev.snapshot().size(device) is None:
+            raise exception.InvalidInput(
+                reason=_("%s is not a block device") % device)
+        # the image size, set by the copy once the image is there
+        image_size = (os.path.getsize(CONF.image_file)
+                      if os.path.exists(CONF.image_file) else 0)
+        progress = Progress(image_size)
+
+        def _load_image_cb():
+            if os.path.exists(CONF.image_converted_flag):
+                os.unlink(CONF.image_converted_flag)
+            with timeline.phase('image_convert'):
+                loaded = imageutils.load(
+                    CONF.image_file, device,
+                    lambda: os.path.exists(CONF.image_downloaded_flag),
+                    progress)
+            if loaded:
+                open(CONF.image_converted_flag, 'a').close()
+
+        return addtask(_load_image_cb, kind='image', priority=PRIORITY_HIGH,
+                       progress=progress, fingerprint=('load_image', device))
+
+    def boot_timeline(self, request):
+        """ The boot phases recorded by the boot scripts and the service. """
+        return timeline.read()
+
 
 def create_router(mapper):
     controller = HostController()
@@ -42,3 +100,15 @@ def create_router(mapper):
                    controller=controller,
                    action='personality',
                    conditions=dict(method=['POST']))
+    mapper.connect('/service/exec-stats',
+                   controller=controller,
+                   action='exec_stats',
+                   conditions=dict(method=['GET']))
+    mapper.connect('/service/load-image',
+                   controller=controller,
+                   action='load_image',
+                   conditions=dict(method=['POST']))
+    mapper.connect('/service/boot-timeline',
+                   controller=controller,
+                   action='boot_timeline',
+                   conditions=dict(method=['GET']))
@@ -0,0 +1,131 @@
+from eventlet import tpool
+
+from wormhole.i18n import _
+from wormhole.common import excutils
+from wormhole.common import importutils
+from wormhole.common import log
+from wormhole.common import processutils
+from wormhole import exception
+from wormhole.lxc_client import LXCClient, LXC_PATH, LXC_TEMPLATE_SCRIPT
+
+import tempfile
+
+lxc = importutils.try_import('lxc')
+
+LOG = log.getLogger(__name__)
+
+
+def is_available():
+    return lxc is not None
+
+
+class LiblxcClient(LXCClient):
+    """ LXCClient driving liblxc in-process through the python binding.
+
+    Calls which may block inside liblxc (start, wait, stop, attach) are
+    run on the native thread pool so they don't stall the eventlet hub.
+    Everything not overridden here still goes through the lxc CLI.
+    """
+
+    def _container(self, name):
+        # A fresh object reloads the config, which add_interfaces and
+        # attach_volume may have changed since the last call.
+        c = lxc.Container(name, LXC_PATH)
+        if not c.defined:
+            raise exception.ContainerNotFound()
+        return c
+
+    def execute(self, container_id, *cmd):
+        c = self._container(container_id)
+        with tempfile.TemporaryFile() as out, \
+                tempfile.TemporaryFile() as err:
+            code = tpool.execute(c.attach_wait, lxc.attach_run_command,
+                                 list(cmd), stdout=out, stderr=err)
+            out.seek(0)
+            err.seek(0)
+            stdout, stderr = out.read(), err.read()
+        if code != 0:
+            raise processutils.ProcessExecutionError(
+                exit_code=code, stdout=stdout, stderr=stderr,
+                cmd=' '.join(cmd))
+        return stdout
+
+    def list(self, all=True):
+        containers = []
+        for name in lxc.list_containers(config_path=LXC_PATH):
+            state = lxc.Container(name, LXC_PATH).state
+            containers.append({'id': name, 'status': state, 'name': name})
+        return containers
+
+    def inspect_container(self, container_id):
+        pid = self._container(container_id).init_pid
+        return {'State': {'Pid': str(pid)}} if pid > 0 else {}
+
+    def get_pid(self, name):
+        try:
+            pid = self._container(name).init_pid
+        except exception.ContainerNotFound:
+            return None
+        return str(pid) if pid > 0 else None
+
+    def create_container(self, name, network_disabled=False):
+        c = lxc.Container(name, LXC_PATH)
+        if not tpool.execute(c.create, LXC_TEMPLATE_SCRIPT):
+            LOG.error(_('Faild to create container %s'), name)
+            raise exception.ContainerCreateFailed()
+
+    def destroy(self, name, network_info):
+        c = self._container(name)
+        if c.running:
+            tpool.execute(c.stop)
+        if not c.destroy():
+            LOG.error(_('Failed to remove container for %s'), name)
+            raise exception.WormholeException(
+                _('Failed to remove container %s') % name)
+        LOG.info('Destroyed for %s' % name)
+
+    def stop(self, name, timeout):
+        c = self._container(name)
+        if c.state != 'RUNNING':
+            return "Container {} is {}, can't stop it".format(name, c.state)
+        # same as lxc-stop -t: clean shutdown first, then kill
+        if not tpool.execute(c.shutdown, int(timeout)):
+            if not tpool.execute(c.stop):
+                LOG.error(_('Failed to stop container for %s'), name)
+                raise exception.WormholeException(
+                    _('Failed to stop container %s') % name)
+
+    def pause(self, name):
+        if not self._container(name).freeze():
+            LOG.error(_('Failed to pause container for %s'), name)
+            raise exception.WormholeException(
+                _('Failed to pause container %s') % name)
+
+    def unpause(self, name):
+        if not self._container(name).unfreeze():
+            LOG.error(_('Failed to unpause container for %s'), name)
+            raise exception.WormholeException(
+                _('Failed to unpause container %s') % name)
+
+    def _device_node(self, name, device, attach=True):
+        c = self._container(name)
+        ok = c.add_device_node(device) if attach \
+                else c.remove_device_node(device)
+        if not ok:
+            raise exception.WormholeException(
+                _('Failed to %(action)s device %(device)s') %
+                {'action': 'add' if attach else 'remove', 'device': device})
+
+    def start(self, name, network_info=None, block_device_info=None, timeout=10):
+        try:
+            self.add_interfaces(name, network_info, append=False)
+            c = self._container(name)
+            if not tpool.execute(c.start):
+                raise exception.ContainerStartFailed()
+            if not tpool.execute(c.wait, 'RUNNING', int(timeout)):
+                raise exception.ContainerStartFailed()
+        except Exception as ex:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_('Failed to start container'
+                              ' for %(name)s: %(ex)s'),
+                          {'name': name, 'ex': ex})
@@ -3,6 +3,7 @@ from wormhole.i18n import _
 from wormhole.common import log
 from wormhole.common import utils
 from wormhole.common import excutils
+from wormhole.common import processutils
 from wormhole import exception
 from wormhole.net_util import network
 
@@ -11,7 +12,10 @@ import stat
 
 lxc_opts = [
     cfg.StrOpt('vif_driver',
-               default='wormhole.net_util.vifs.GenericVIFDriver'),
+               default='wormhole.net_util.vifs.GenericVIFDriver',
+               help='The VIF driver class. Use '
+                    'wormhole.net_util.vifs.NetlinkVIFDriver to attach '
+                    'interfaces through netlink instead of ip/brctl/ethtool.'),
     cfg.BoolOpt('insecure_registry',
                 default=False,
                 help='Set true if need insecure registry access.'),
@@ -22,8 +26,10 @@ CONF.register_opts(lxc_opts, 'lxc')
 
 LOG = log.getLogger(__name__)
 LXC_MOUNT_DIR = '/lxc/'
+INJECT_CHUNK_SIZE = 64 * 1024
 LXC_PATH = '/var/lib/lxc'
 LXC_TEMPLATE_SCRIPT = '/var/lib/wormhole/bin/lxc-general'
+LXC_CGROUP_ROOT = '/sys/fs/cgroup/devices/lxc/'
 
 LXC_NET_CONFIG_TEMPLATE = """# new network
 lxc.network.type = veth
@@ -55,6 +61,9 @@ def lxc_autodev_hook_script(name, device):
     device_name = os.path.basename(device)
     return lxc_hook_dir(name) + "autodev_" + device_name + ".sh"
 
+def lxc_cgroup_dir(name):
+    return LXC_CGROUP_ROOT + name + "/"
+
 def lxc_net_conf(name, net_name, vif):
 
     conf = "## START %s\n"%vif['id'][:11]
@@ -97,6 +106,55 @@ class LXCClient(object):
         info, _err = utils.execute('lxc-info', '-p', '-n', container_id)
         return {'State': {'Pid': info.split()[-1]}} if info else {}
 
+    def get_pid(self, name):
+        """ Read the init pid of a running container from its cgroup.
+
+        Returns None if the cgroup does not exist or is still empty.
+        """
+        try:
+            with open(lxc_cgroup_dir(name) + 'cgroup.procs') as f:
+                pids = set(f.read().split())
+        except IOError:
+            return None
+        # the members whose parent lives outside the cgroup are init and
+        # the lxc-attach'ed processes, init is the one started first
+        candidates = []
+        for pid in pids:
+            try:
+                with open('/proc/%s/stat' % pid) as f:
+                    # the fields after the command: state, ppid, ... and
+                    # starttime 20th
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except (IOError, IndexError):
+                continue
+            if fields[1] not in pids:
+                candidates.append((int(fields[19]), int(pid)))
+        return str(min(candidates)[1]) if candidates else None
+
+    def wait_for_pid(self, name, timeout=10):
+        """ Wait until the init process of container `name' exists.
+
+        lxc-wait is told by the container monitor as soon as the
+        container is RUNNING, init exists by then. Its pid is read from
+        the container cgroup, or from lxc-info on hosts without the
+        expected cgroup hierarchy (e.g. cgroup v2).
+        """
+        try:
+            utils.execute('lxc-wait', '-n', name, '-s', 'RUNNING',
+                          '-t', timeout)
+        except processutils.ProcessExecutionError as e:
+            LOG.warn(_("Container %(name)s not running after %(timeout)ss: "
+                       "%(err)s"),
+                     {'name': name, 'timeout': timeout, 'err': e})
+            return None
+        pid = self.get_pid(name)
+        if pid:
+            return pid
+        info = self.inspect_container(name)
+        if info and info['State']['Pid'] not in ('', '0'):
+            return info['State']['Pid']
+        return None
+
     def create_container(self, name, network_disabled=False):
         try:
             utils.execute('lxc-create', '-n', name, '-t', LXC_TEMPLATE_SCRIPT)
@@ -163,17 +221,45 @@ class LXCClient(object):
         else:
             raise exception.DirNotFound(dir=os.path.dirname(path))
 
+    def inject_file_stream(self, name, path, fileobj, mode=None):
+        """ Copy `fileobj` to `path` in the container a chunk at a time.
+
+        Missing parent dirs are created. The target must stay inside the
+        container root, symbolic links included.
+        """
+        root = os.path.realpath(LXC_MOUNT_DIR)
+        target = os.path.normpath(LXC_MOUNT_DIR + path)
+        parent = os.path.realpath(os.path.dirname(target))
+        if not (parent + os.path.sep).startswith(root + os.path.sep):
+            raise exception.InvalidInput(
+                    reason='"%s" is outside of the container' % path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        target = os.path.join(parent, os.path.basename(target))
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     os.O_NOFOLLOW, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = fileobj.read(INJECT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+            if mode is not None:
+                os.fchmod(f.fileno(), mode & 0o7777)
+
     def read_file(self, name, path):
         with open(LXC_MOUNT_DIR + path, 'r') as f: return f.read()
 
-    def _dynamic_attach_or_detach_volume(self, name, device, maj, min, attach=True):
-
+    def _device_node(self, name, device, attach=True):
         action = 'add' if attach else 'del'
-
         utils.execute('lxc-device', '-n', name, action, device)
 
-        cgroup_device_allow = '/sys/fs/cgroup/devices/lxc/%s/devices.%s' \
-                                %(name, 'allow' if attach else 'deny')
+    def _dynamic_attach_or_detach_volume(self, name, device, maj, min, attach=True):
+
+        self._device_node(name, device, attach)
+
+        cgroup_device_allow = lxc_cgroup_dir(name) + 'devices.%s' \
+                                % ('allow' if attach else 'deny')
         for i in range(1, 16):
             with open(cgroup_device_allow, 'w') as f:
                 f.write('b %(maj)s:%(min)s rwm\n'%{'maj':maj, 'min':min+i})
@@ -38,6 +38,7 @@ from wormhole.common import processutils
 from wormhole.common import timeutils
 from wormhole import paths
 from wormhole.common import utils
+from wormhole.net_util import ovsdb
 
 LOG = logging.getLogger(__name__)
 
@@ -166,22 +167,80 @@ def create_ovs_bridge(bridge_name):
     _set_device_mtu(bridge_name)
 
 
+class OVSTransaction(object):
+    """Batch of ovs-vsctl commands committed in a single invocation.
+
+    Every queued command becomes one '--' separated clause of the same
+    ovs-vsctl call, so ovsdb-server sees a single transaction however
+    many ports are touched. Callbacks registered with on_commit run after
+    the transaction succeeded, e.g. to tune the devices it created.
+    """
+
+    def __init__(self):
+        self._commands = []
+        self._post_commit = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+
+    def add_command(self, *args):
+        self._commands.append([str(a) for a in args])
+
+    def add_port(self, bridge, dev):
+        self.add_command('--may-exist', 'add-port', bridge, dev)
+
+    def del_port(self, bridge, dev):
+        self.add_command('--if-exists', 'del-port', bridge, dev)
+
+    def set(self, table, record, *values):
+        self.add_command('set', table, record, *values)
+
+    def on_commit(self, func, *args, **kwargs):
+        self._post_commit.append((func, args, kwargs))
+
+    def commit(self):
+        commands, self._commands = self._commands, []
+        post_commit, self._post_commit = self._post_commit, []
+        if commands:
+            args = []
+            for cmd in commands:
+                args.append('--')
+                args.extend(cmd)
+            _ovs_vsctl(args)
+        for func, args, kwargs in post_commit:
+            func(*args, **kwargs)
+
+
 def create_ovs_vif_port(bridge, dev, iface_id, mac, instance_id,
-                        internal=False):
-    delete_ovs_vif_port(bridge, dev)
-    #interface_args = ['--', '--if-exists', 'del-port', dev, '--',
-    interface_args = ['--', 'add-port', bridge, dev,
-                      '--', 'set', 'Interface', dev,
-                      'external-ids:iface-id=%s' % iface_id,
+                        internal=False, txn=None):
+    """Replace port `dev` on `bridge`.
+
+    The port is queued on `txn` when given, the caller is then
+    responsible for committing it; otherwise it is committed at once.
+    """
+    commit = txn is None
+    if commit:
+        txn = OVSTransaction()
+    interface_args = ['external-ids:iface-id=%s' % iface_id,
                       'external-ids:iface-status=active',
                       'external-ids:attached-mac=%s' % mac,
                       'external-ids:vm-uuid=%s' % instance_id]
-
     if internal:
         interface_args.append("type=internal")
 
-    _ovs_vsctl(interface_args)
-    _set_device_mtu(dev)
+    txn.del_port(bridge, dev)
+    txn.add_port(bridge, dev)
+    txn.set('Interface', dev, *interface_args)
+    txn.on_commit(_set_device_mtu, dev)
+    if commit:
+        txn.commit()
 
 def create_ovs_patch_port(bridge_name, local_name, remote_name):
     interface_args = ['--', '--may-exist', 'add-port', bridge_name, local_name,
@@ -191,6 +250,9 @@ def create_ovs_patch_port(bridge_name, local_name, remote_name):
     _ovs_vsctl(interface_args)
 
 def get_ovs_port_ofport(port_name):
+    if CONF.ovsdb_native:
+        ofport = ovsdb.get_client().get_ofport(port_name)
+        return str(ofport) if ofport is not None else None
     interface_args = (["get", "Interface", port_name, "ofport"])
     output = _ovs_vsctl(interface_args)
     if output:
@@ -200,9 +262,14 @@ def delete_ovs_bridge(bridge_name):
     bridge_args = ['--', '--if-exists', 'del-br', bridge_name]
     _ovs_vsctl(bridge_args)
 
-def delete_ovs_vif_port(bridge, dev):
-    _ovs_vsctl(['--', '--if-exists', 'del-port', bridge, dev])
-    delete_net_dev(dev)
+def delete_ovs_vif_port(bridge, dev, txn=None):
+    commit = txn is None
+    if commit:
+        txn = OVSTransaction()
+    txn.del_port(bridge, dev)
+    txn.on_commit(delete_net_dev, dev)
+    if commit:
+        txn.commit()
 
 def delete_ovs_flows(bridge, ofport):
     flow_args = ['del-flows', bridge, 'in_port=%s' % ofport]
@@ -309,6 +376,8 @@ def create_evs_virtio_port_bind_numa(bridge, dev, numa_id, iface_id, mac, instan
 
 
 def bridge_exists(bridge_name):
+    if CONF.ovsdb_native:
+        return ovsdb.get_client().bridge_exists(bridge_name)
     try:
         _ovs_vsctl(['br-exists', bridge_name])
     except RuntimeError as e:
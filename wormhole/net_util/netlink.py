@@ -0,0 +1,302 @@
+# Copyright 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Minimal in-process rtnetlink and ioctl helpers.
+
+Only the handful of operations needed to wire a veth pair into a
+container network namespace are implemented: link creation, link
+attribute changes, address and default route setup, and TSO toggling.
+"""
+
+import contextlib
+import ctypes
+import errno
+import fcntl
+import os
+import socket
+import struct
+
+from wormhole.common import log as logging
+from wormhole.i18n import _
+
+LOG = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_OIF = 4
+RTA_GATEWAY = 5
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+
+IFF_UP = 0x1
+
+SIOCGIFINDEX = 0x8933
+SIOCETHTOOL = 0x8946
+ETHTOOL_STSO = 0x1f
+
+CLONE_NEWNET = 0x40000000
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_RTATTR = struct.Struct('=HH')
+_IFINFOMSG = struct.Struct('=BxHiII')
+_IFADDRMSG = struct.Struct('=BBBBi')
+_RTMSG = struct.Struct('=BBBBBBBBI')
+_NLMSGERR = struct.Struct('=i')
+
+
+class NetlinkError(Exception):
+    def __init__(self, code, msg=None):
+        self.code = code
+        message = msg or os.strerror(code)
+        super(NetlinkError, self).__init__(
+            _('Netlink request failed: %(msg)s (errno %(code)s)') %
+            {'msg': message, 'code': code})
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attr(attr_type, payload):
+    length = _RTATTR.size + len(payload)
+    return (_RTATTR.pack(length, attr_type) + payload +
+            b'\0' * (_align(length) - length))
+
+
+def _attr_str(attr_type, value):
+    return _attr(attr_type, value.encode('ascii') + b'\0')
+
+
+def _attr_u32(attr_type, value):
+    return _attr(attr_type, struct.pack('=I', value))
+
+
+def _inet(address):
+    """(family, packed address) of an IPv4 or IPv6 address."""
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    return family, socket.inet_pton(family, address)
+
+
+def _mac_to_bytes(mac):
+    return b''.join(struct.pack('B', int(x, 16)) for x in mac.split(':'))
+
+
+def _link_attrs(ifname=None, address=None, mtu=None, master=None,
+                net_ns_fd=None):
+    attrs = b''
+    if ifname is not None:
+        attrs += _attr_str(IFLA_IFNAME, ifname)
+    if address is not None:
+        attrs += _attr(IFLA_ADDRESS, _mac_to_bytes(address))
+    if mtu is not None:
+        attrs += _attr_u32(IFLA_MTU, int(mtu))
+    if master is not None:
+        attrs += _attr_u32(IFLA_MASTER, master)
+    if net_ns_fd is not None:
+        attrs += _attr_u32(IFLA_NET_NS_FD, net_ns_fd)
+    return attrs
+
+
+_libc = None
+
+
+def _setns(fd):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+
+@contextlib.contextmanager
+def netns(path):
+    """Temporarily switch the calling thread into the netns at `path`.
+
+    Sockets created inside the block stay bound to that namespace after
+    the thread switches back, which is all we need it for. Nothing in the
+    block may yield to another greenthread.
+    """
+    self_fd = os.open('/proc/self/ns/net', os.O_RDONLY)
+    target_fd = os.open(path, os.O_RDONLY)
+    try:
+        _setns(target_fd)
+        try:
+            yield
+        finally:
+            _setns(self_fd)
+    finally:
+        os.close(target_fd)
+        os.close(self_fd)
+
+
+class IPRoute(object):
+    """A single rtnetlink socket, optionally opened in another netns."""
+
+    def __init__(self, netns_path=None):
+        self._seq = 0
+        if netns_path:
+            with netns(netns_path):
+                self._open()
+        else:
+            self._open()
+
+    def _open(self):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                   NETLINK_ROUTE)
+        self._sock.bind((0, 0))
+        # ioctl requests must be issued from the same namespace
+        self._ioctl_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def close(self):
+        self._sock.close()
+        self._ioctl_sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _request(self, msg_type, flags, body):
+        self._seq += 1
+        seq = self._seq
+        length = _NLMSGHDR.size + len(body)
+        self._sock.send(_NLMSGHDR.pack(length, msg_type,
+                                       flags | NLM_F_REQUEST | NLM_F_ACK,
+                                       seq, 0) + body)
+        while True:
+            data = self._sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                (msg_len, rsp_type, _flags, rsp_seq,
+                 _pid) = _NLMSGHDR.unpack_from(data, offset)
+                if rsp_seq == seq:
+                    if rsp_type == NLMSG_ERROR:
+                        (code,) = _NLMSGERR.unpack_from(
+                            data, offset + _NLMSGHDR.size)
+                        if code:
+                            raise NetlinkError(-code)
+                        return
+                    if rsp_type == NLMSG_DONE:
+                        return
+                offset += _align(msg_len)
+
+    def link_lookup(self, ifname):
+        """Return the ifindex of `ifname` in this socket's namespace."""
+        ifr = struct.pack('16si', ifname.encode('ascii'), 0)
+        try:
+            res = fcntl.ioctl(self._ioctl_sock.fileno(), SIOCGIFINDEX, ifr)
+        except IOError as e:
+            if e.errno == errno.ENODEV:
+                return None
+            raise
+        return struct.unpack('16si', res)[1]
+
+    def link_index(self, ifname):
+        index = self.link_lookup(ifname)
+        if index is None:
+            raise NetlinkError(errno.ENODEV,
+                               _('No such device: %s') % ifname)
+        return index
+
+    def link_add_veth(self, ifname, peer, peer_netns_fd=None,
+                      peer_address=None, peer_mtu=None):
+        """Create a veth pair, optionally creating `peer` directly inside
+        another namespace with its final MAC and MTU.
+        """
+        peer_info = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        peer_info += _link_attrs(ifname=peer, address=peer_address,
+                                 mtu=peer_mtu, net_ns_fd=peer_netns_fd)
+        linkinfo = (_attr_str(IFLA_INFO_KIND, 'veth') +
+                    _attr(IFLA_INFO_DATA, _attr(VETH_INFO_PEER, peer_info)))
+        body = (_IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) +
+                _attr_str(IFLA_IFNAME, ifname) +
+                _attr(IFLA_LINKINFO, linkinfo))
+        self._request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, body)
+
+    def link_del(self, ifname):
+        body = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, self.link_index(ifname),
+                               0, 0)
+        self._request(RTM_DELLINK, 0, body)
+
+    def link_set(self, ifname, up=None, **attrs):
+        """Change link attributes (ifname, address, mtu, master,
+        net_ns_fd) and/or the administrative state in one request.
+        """
+        flags = change = 0
+        if up is not None:
+            change = IFF_UP
+            flags = IFF_UP if up else 0
+        body = (_IFINFOMSG.pack(socket.AF_UNSPEC, 0, self.link_index(ifname),
+                                flags, change) +
+                _link_attrs(**attrs))
+        self._request(RTM_NEWLINK, 0, body)
+
+    def addr_add(self, ifname, cidr):
+        address, prefixlen = cidr.split('/')
+        family, packed = _inet(address)
+        body = (_IFADDRMSG.pack(family, int(prefixlen), 0,
+                                RT_SCOPE_UNIVERSE, self.link_index(ifname)) +
+                _attr(IFA_LOCAL, packed) + _attr(IFA_ADDRESS, packed))
+        self._request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_REPLACE, body)
+
+    def route_replace_default(self, gateway, ifname):
+        family, packed = _inet(gateway)
+        body = (_RTMSG.pack(family, 0, 0, 0, RT_TABLE_MAIN,
+                            RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0) +
+                _attr(RTA_GATEWAY, packed) +
+                _attr_u32(RTA_OIF, self.link_index(ifname)))
+        self._request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE, body)
+
+    def set_tso(self, ifname, enabled):
+        """Equivalent of `ethtool --offload <ifname> tso on|off`."""
+        value = ctypes.create_string_buffer(
+            struct.pack('=II', ETHTOOL_STSO, 1 if enabled else 0))
+        ifr = struct.pack('16sP', ifname.encode('ascii'),
+                          ctypes.addressof(value))
+        ifr += b'\0' * (40 - len(ifr))
+        fcntl.ioctl(self._ioctl_sock.fileno(), SIOCETHTOOL, ifr)
@@ -0,0 +1,295 @@
+# Copyright 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""In-process OVSDB client (RFC 7047 JSON-RPC).
+
+One connection to ovsdb-server is kept open for the life of the service.
+The schema is fetched once, and the Bridge, Port and Interface tables are
+monitored so that read-only lookups are answered from a local replica
+instead of forking ovs-vsctl.
+
+wormhole.net_util.ovsdb_standin serves the same protocol without Open
+vSwitch, to exercise the client locally.
+"""
+
+import codecs
+import itertools
+import json
+
+import eventlet
+from eventlet import event
+from eventlet.green import socket
+from eventlet import semaphore
+from oslo.config import cfg
+
+from wormhole.common import log as logging
+from wormhole.i18n import _
+
+LOG = logging.getLogger(__name__)
+
+ovsdb_opts = [
+    cfg.BoolOpt('ovsdb_native',
+                default=False,
+                help='Answer OVS lookups through a persistent OVSDB '
+                     'connection instead of ovs-vsctl.'),
+    cfg.StrOpt('ovsdb_connection',
+               default='unix:/var/run/openvswitch/db.sock',
+               help='OVSDB server to connect to, as unix:<path> or '
+                    'tcp:<host>:<port>.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ovsdb_opts)
+
+DATABASE = 'Open_vSwitch'
+
+MONITORED_TABLES = {
+    'Bridge': ['name', 'ports'],
+    'Port': ['name', 'interfaces', 'tag'],
+    'Interface': ['name', 'ofport', 'type', 'external_ids'],
+}
+
+
+class OvsdbError(Exception):
+    pass
+
+
+def _decode(value):
+    """Convert an OVSDB JSON value to plain python types."""
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'set':
+            return [_decode(v) for v in data]
+        if kind == 'map':
+            return dict((_decode(k), _decode(v)) for k, v in data)
+        if kind in ('uuid', 'named-uuid'):
+            return data
+    return value
+
+
+def _scalar(value):
+    """Unwrap optional columns, stored as empty or singleton sets."""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+class OvsdbClient(object):
+
+    def __init__(self, connection=None):
+        self.connection = connection or CONF.ovsdb_connection
+        self._sock = None
+        self._reader = None
+        self._ids = itertools.count()
+        self._pending = {}
+        # calls whose result is applied to the replica, by the reader
+        self._monitor_calls = set()
+        self._send_lock = semaphore.Semaphore()
+        self._connect_lock = semaphore.Semaphore()
+        self._schema = None
+        self._tables = {}
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def _open_socket(self):
+        proto, _sep, addr = self.connection.partition(':')
+        if proto == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(addr)
+        elif proto == 'tcp':
+            host, _sep, port = addr.rpartition(':')
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((host, int(port)))
+        else:
+            raise OvsdbError(_('Unsupported OVSDB connection %s') %
+                             self.connection)
+        return sock
+
+    def connect(self):
+        """Connect, fetch the schema and start monitoring, if needed."""
+        with self._connect_lock:
+            if self.connected:
+                return
+            LOG.debug("Connecting to OVSDB %s", self.connection)
+            self._sock = self._open_socket()
+            self._reader = eventlet.spawn(self._read_loop, self._sock)
+            try:
+                if self._schema is None:
+                    self._schema = self._call('get_schema', [DATABASE])
+                monitor = dict((table, {'columns': columns})
+                               for table, columns in MONITORED_TABLES.items())
+                # the reader applies the initial rows before any update
+                # that follows them, so none is lost or applied twice
+                self._tables = dict((t, {}) for t in MONITORED_TABLES)
+                self._call('monitor', [DATABASE, None, monitor],
+                           monitor=True)
+            except Exception:
+                self._disconnect(self._sock)
+                raise
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.kill()
+        self._disconnect(self._sock)
+
+    def _disconnect(self, sock):
+        if sock is None or sock is not self._sock:
+            return
+        self._sock = None
+        self._tables = {}
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        pending, self._pending = self._pending, {}
+        self._monitor_calls.clear()
+        for waiter in pending.values():
+            waiter.send_exception(
+                OvsdbError(_('Connection to OVSDB %s lost') %
+                           self.connection))
+
+    def _send(self, sock, msg):
+        with self._send_lock:
+            sock.sendall(json.dumps(msg).encode('utf-8'))
+
+    def _call(self, method, params, monitor=False):
+        sock = self._sock
+        if sock is None:
+            raise OvsdbError(_('Not connected to OVSDB %s') % self.connection)
+        msg_id = next(self._ids)
+        waiter = event.Event()
+        self._pending[msg_id] = waiter
+        if monitor:
+            self._monitor_calls.add(msg_id)
+        try:
+            self._send(sock, {'method': method, 'params': params,
+                              'id': msg_id})
+        except socket.error:
+            self._pending.pop(msg_id, None)
+            self._monitor_calls.discard(msg_id)
+            self._disconnect(sock)
+            raise
+        return waiter.wait()
+
+    def _read_loop(self, sock):
+        decoder = json.JSONDecoder()
+        # a character may be split across two reads
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        buf = u''
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buf += utf8.decode(data)
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        msg, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        # incomplete message, wait for more data
+                        break
+                    buf = buf[end:]
+                    self._dispatch(sock, msg)
+        except (socket.error, UnicodeDecodeError) as e:
+            LOG.warn(_("OVSDB connection %(conn)s failed: %(err)s"),
+                     {'conn': self.connection, 'err': e})
+        finally:
+            self._disconnect(sock)
+
+    def _dispatch(self, sock, msg):
+        method = msg.get('method')
+        if method == 'echo':
+            self._send(sock, {'result': msg.get('params', []),
+                              'error': None, 'id': msg.get('id')})
+        elif method == 'update':
+            self._apply_updates(msg['params'][1])
+        elif method is None:
+            waiter = self._pending.pop(msg.get('id'), None)
+            if waiter is None:
+                return
+            monitor = msg.get('id') in self._monitor_calls
+            self._monitor_calls.discard(msg.get('id'))
+            if msg.get('error'):
+                waiter.send_exception(OvsdbError(msg['error']))
+                return
+            if monitor:
+                self._apply_updates(msg.get('result'))
+            waiter.send(msg.get('result'))
+
+    def _apply_updates(self, updates):
+        for table, rows in (updates or {}).items():
+            replica = self._tables.setdefault(table, {})
+            for uuid, change in rows.items():
+                new = change.get('new')
+                if new is None:
+                    replica.pop(uuid, None)
+                    continue
+                row = replica.setdefault(uuid, {})
+                for column, value in new.items():
+                    row[column] = _decode(value)
+
+    def get_schema(self):
+        self.connect()
+        return self._schema
+
+    def transact(self, *operations):
+        self.connect()
+        result = self._call('transact', [DATABASE] + list(operations))
+        for res in result:
+            if res and res.get('error'):
+                raise OvsdbError(res)
+        return result
+
+    def find_rows(self, table, **conditions):
+        """Return the replica rows of `table` matching all `conditions`."""
+        self.connect()
+        return [row for row in self._tables.get(table, {}).values()
+                if all(row.get(k) == v for k, v in conditions.items())]
+
+    def bridge_exists(self, bridge_name):
+        return bool(self.find_rows('Bridge', name=bridge_name))
+
+    def port_exists(self, port_name):
+        return bool(self.find_rows('Port', name=port_name))
+
+    def get_ofport(self, port_name):
+        """Return the OpenFlow port number of interface `port_name`."""
+        rows = self.find_rows('Interface', name=port_name)
+        ofport = _scalar(rows[0].get('ofport')) if rows else None
+        if ofport is None:
+            # The monitor update may still be in flight right after the
+            # port was added, ask the server directly.
+            result = self.transact({'op': 'select', 'table': 'Interface',
+                                    'where': [['name', '==', port_name]],
+                                    'columns': ['ofport']})
+            rows = result[0].get('rows', [])
+            if rows:
+                ofport = _scalar(_decode(rows[0].get('ofport')))
+        return ofport
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = OvsdbClient()
+    return _client
@@ -0,0 +1,180 @@
+# Copyright 2014 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stand-in ovsdb-server, to exercise OvsdbClient without Open vSwitch.
+
+Serves get_schema, monitor, transact (insert, update, delete and select
+on the monitored tables) and echo, and pushes update notifications to
+the monitoring clients, as ovsdb-server does:
+
+    python -m wormhole.net_util.ovsdb_standin unix:/tmp/ovsdb.sock
+
+then point ovsdb_connection at the same address.
+"""
+
+import codecs
+import json
+import os
+import sys
+import uuid
+
+import eventlet
+from eventlet.green import socket
+
+from wormhole.net_util import ovsdb
+
+
+def _matches(row, where):
+    for column, function, value in where:
+        if function == '==' and row.get(column) != value:
+            return False
+        if function == '!=' and row.get(column) == value:
+            return False
+    return True
+
+
+class StandinServer(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.tables = dict((t, {}) for t in ovsdb.MONITORED_TABLES)
+        self._monitors = []
+        self._sock = None
+
+    def listen(self):
+        proto, _sep, addr = self.connection.partition(':')
+        if proto == 'unix':
+            if os.path.exists(addr):
+                os.unlink(addr)
+            self._sock = eventlet.listen(addr, family=socket.AF_UNIX)
+        else:
+            host, _sep, port = addr.rpartition(':')
+            self._sock = eventlet.listen((host, int(port)))
+        return self
+
+    def serve(self):
+        """Accept and serve clients in the current greenthread."""
+        while True:
+            sock, _addr = self._sock.accept()
+            eventlet.spawn_n(self._serve_client, sock)
+
+    def start(self):
+        eventlet.spawn_n(self.listen().serve)
+        return self
+
+    def _serve_client(self, sock):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        buf = u''
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buf += utf8.decode(data)
+                while buf.strip():
+                    buf = buf.lstrip()
+                    try:
+                        msg, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    self._reply(sock, msg)
+        except socket.error:
+            pass
+        finally:
+            self._monitors = [m for m in self._monitors if m[0] is not sock]
+            sock.close()
+
+    def _send(self, sock, msg):
+        sock.sendall(json.dumps(msg).encode('utf-8'))
+
+    def _reply(self, sock, msg):
+        method, params = msg.get('method'), msg.get('params', [])
+        result, error = None, None
+        if method == 'echo':
+            result = params
+        elif method == 'get_schema':
+            result = {'name': ovsdb.DATABASE, 'tables': dict(
+                (table, {'columns': dict((c, {'type': 'string'})
+                                         for c in columns)})
+                for table, columns in ovsdb.MONITORED_TABLES.items())}
+        elif method == 'monitor':
+            self._monitors.append((sock, params[1]))
+            result = dict((table, dict((u, {'new': row})
+                                       for u, row in rows.items()))
+                          for table, rows in self.tables.items())
+        elif method == 'transact':
+            result, updates = self._transact(params[1:])
+            if updates:
+                for monitor_sock, monitor_id in list(self._monitors):
+                    self._send(monitor_sock, {'method': 'update',
+                                              'params': [monitor_id, updates],
+                                              'id': None})
+        else:
+            error = 'unknown method'
+        if msg.get('id') is not None:
+            self._send(sock, {'result': result, 'error': error,
+                              'id': msg['id']})
+
+    def _transact(self, operations):
+        results, updates = [], {}
+        for op in operations:
+            rows = self.tables.get(op.get('table'), {})
+            changes = updates.setdefault(op.get('table'), {})
+            where = op.get('where', [])
+            if op['op'] == 'insert':
+                row_uuid = str(uuid.uuid4())
+                rows[row_uuid] = dict(op['row'])
+                changes[row_uuid] = {'new': rows[row_uuid]}
+                results.append({'uuid': ['uuid', row_uuid]})
+            elif op['op'] == 'update':
+                count = 0
+                for row_uuid, row in rows.items():
+                    if _matches(row, where):
+                        old = dict(row)
+                        row.update(op['row'])
+                        changes[row_uuid] = {'old': old, 'new': row}
+                        count += 1
+                results.append({'count': count})
+            elif op['op'] == 'delete':
+                count = 0
+                for row_uuid, row in list(rows.items()):
+                    if _matches(row, where):
+                        changes[row_uuid] = {'old': rows.pop(row_uuid)}
+                        count += 1
+                results.append({'count': count})
+            elif op['op'] == 'select':
+                columns = op.get('columns')
+                results.append({'rows': [
+                    dict((c, v) for c, v in row.items()
+                         if columns is None or c in columns)
+                    for row in rows.values() if _matches(row, where)]})
+            else:
+                results.append({'error': 'not supported',
+                                'details': op['op']})
+        return results, dict((t, c) for t, c in updates.items() if c)
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: %s unix:<path>|tcp:<host>:<port>\n' %
+                         sys.argv[0])
+        return 2
+    StandinServer(sys.argv[1]).listen().serve()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,6 +15,7 @@
 #    under the License.
 
 
+from wormhole.common import excutils
 from wormhole.common import processutils
 from wormhole.common import log as logging
 from wormhole import exception
@@ -25,8 +26,11 @@ from oslo.config import cfg
 
 from . import linux_net
 from . import model as network_model
+from . import netlink
 from . import network
 
+import functools
+import os
 import random
 
 network_opts = [
@@ -34,6 +38,10 @@ network_opts = [
                default=9000,
                help='DEPRECATED: THIS VALUE SHOULD BE SET WHEN CREATING THE '
                     'NETWORK. MTU setting for network interface.'),
+    cfg.IntOpt('vif_concurrency',
+               default=4,
+               help='Maximum number of VIFs plugged or attached '
+                    'concurrently.'),
 ]
 
 CONF = cfg.CONF
@@ -44,6 +52,12 @@ LOG = logging.getLogger(__name__)
 
 class GenericVIFDriver(object):
 
+    def _check_vif_type(self, vif):
+        if vif['type'] is None:
+            raise exception.WormholeException(
+                _("Vif_type parameter must be present "
+                  "for this vif_driver implementation"))
+
     def plug(self, vif, instance):
         vif_type = vif['type']
 
@@ -52,14 +66,21 @@ class GenericVIFDriver(object):
                   {'vif_type': vif_type, 'instance': instance,
                    'vif': vif})
 
-        if vif_type is None:
-            raise exception.WormholeException(
-                _("Vif_type parameter must be present "
-                  "for this vif_driver implementation"))
+        self._check_vif_type(vif)
 
         # bypass vif check
         self.plug_ovs_hybrid(instance, vif)
 
+    def plug_vifs(self, network_info, instance):
+        """Plug every VIF of network_info with one OVS transaction."""
+        LOG.debug('plug vifs instance=%(instance)s network_info=%(vifs)s',
+                  {'instance': instance, 'vifs': network_info})
+
+        for vif in network_info:
+            self._check_vif_type(vif)
+
+        self.plug_ovs_hybrid_vifs(instance, network_info)
+
     def plug_ovs_hybrid(self, instance, vif):
         """Plug using hybrid strategy
 
@@ -67,50 +88,84 @@ class GenericVIFDriver(object):
         integration bridge via an ovs internal port device. Then boot the
         VIF on the linux bridge using standard net_util mechanisms.
         """
-        if_local_name = 'tap%s' % vif['id'][:11]
-        if_remote_name = 'ns%s' % vif['id'][:11]
-        iface_id = self.get_ovs_interfaceid(vif)
-        br_name = self.get_br_name(vif['id'])
-        vm_port_name = self.get_vm_ovs_port_name(vif['id'])
-        # Device already exists so return.
-        if linux_net.device_exists(if_local_name):
-            return
+        self.plug_ovs_hybrid_vifs(instance, [vif])
+
+    def _create_linux_bridge(self, br_name, undo_mgr):
+        utils.execute('brctl', 'addbr', br_name, run_as_root=True)
+        undo_mgr.undo_with(functools.partial(utils.execute, 'brctl', 'delbr',
+                                             br_name, run_as_root=True))
+        utils.execute('brctl', 'setfd', br_name, 0, run_as_root=True)
+        utils.execute('brctl', 'stp', br_name, 'off', run_as_root=True)
+        utils.execute('tee',
+                      ('/sys/class/net/%s/bridge/multicast_snooping' %
+                       br_name),
+                      process_input='0',
+                      run_as_root=True,
+                      check_exit_code=[0, 1])
+
+    def plug_ovs_hybrid_vifs(self, instance, network_info):
+        """Hybrid plug several VIFs at once.
+
+        The linux bridges are created per VIF, but all OVS ports are
+        replaced in a single ovs-vsctl transaction, and the integration
+        bridges are only brought up once.
+        """
         undo_mgr = utils.UndoManager()
+        txn = linux_net.OVSTransaction()
+        undo_txn = linux_net.OVSTransaction()
+        plugged = []
 
-        try:
+        def _prepare(vif):
+            if_local_name = 'tap%s' % vif['id'][:11]
+            br_name = self.get_br_name(vif['id'])
+            # Device already exists so skip it.
+            if linux_net.device_exists(if_local_name):
+                return
             if not linux_net.device_exists(br_name):
-                utils.execute('brctl', 'addbr', br_name, run_as_root=True)
-                undo_mgr.undo_with(lambda: utils.execute('brctl', 'delbr', br_name, run_as_root=True))
-                utils.execute('brctl', 'setfd', br_name, 0, run_as_root=True)
-                utils.execute('brctl', 'stp', br_name, 'off', run_as_root=True)
-                utils.execute('tee',
-                              ('/sys/class/net/%s/bridge/multicast_snooping' %
-                               br_name),
-                              process_input='0',
-                              run_as_root=True,
-                              check_exit_code=[0, 1])
-
-            #fix bridge's state is down after host reboot.
-            
-            linux_net.create_ovs_vif_port(self.get_bridge_name(vif),
-                                          vm_port_name, iface_id,
-                                          vif['address'], instance,
-                                          internal=True)
-            undo_mgr.undo_with(
-                lambda: utils.execute('ovs-vsctl', 'del-port',
-                                       self.get_bridge_name(vif),
-                                       vm_port_name, run_as_root=True))
-            utils.execute('ip', 'link', 'set', self.get_bridge_name(vif), 'up', run_as_root=True)
-            utils.execute('ip', 'link', 'set', vm_port_name, 'up', run_as_root=True)
-            utils.execute('ip', 'link', 'set', br_name, 'up', run_as_root=True)
+                self._create_linux_bridge(br_name, undo_mgr)
+            return vif
 
+        def _link_up(names):
+            br_name, vm_port_name = names
+            utils.execute('ip', 'link', 'set', vm_port_name, 'up',
+                          run_as_root=True)
+            utils.execute('ip', 'link', 'set', br_name, 'up',
+                          run_as_root=True)
             utils.execute('brctl', 'addif', br_name, vm_port_name,
-                                run_as_root=True)
+                          run_as_root=True)
+
+        try:
+            # linux bridges are independent of each other, create them
+            # concurrently before queueing the OVS side
+            to_plug = utils.green_map(_prepare, network_info,
+                                      CONF.vif_concurrency)
+            for vif in filter(None, to_plug):
+                br_name = self.get_br_name(vif['id'])
+                vm_port_name = self.get_vm_ovs_port_name(vif['id'])
+                linux_net.create_ovs_vif_port(self.get_bridge_name(vif),
+                                              vm_port_name,
+                                              self.get_ovs_interfaceid(vif),
+                                              vif['address'], instance,
+                                              internal=True, txn=txn)
+                undo_txn.del_port(self.get_bridge_name(vif), vm_port_name)
+                plugged.append((br_name, vm_port_name))
+
+            if not plugged:
+                return
+
+            txn.commit()
+            undo_mgr.undo_with(undo_txn.commit)
+
+            #fix bridge's state is down after host reboot.
+            for bridge in set(self.get_bridge_name(vif)
+                              for vif in network_info):
+                utils.execute('ip', 'link', 'set', bridge, 'up',
+                              run_as_root=True)
+            utils.green_map(_link_up, plugged, CONF.vif_concurrency)
 
         except Exception:
             msg = "Failed to configure Network." \
-                " Rolling back the network interfaces %s %s" % (
-                    br_name, vm_port_name)
+                " Rolling back the network interfaces %s" % plugged
             undo_mgr.rollback_and_reraise(msg=msg, instance=instance)
 
     def unplug(self, instance, vif):
@@ -121,36 +176,63 @@ class GenericVIFDriver(object):
                   {'vif_type': vif_type, 'instance': instance,
                    'vif': vif})
 
-        if vif_type is None:
-            raise exception.WormholeException(
-                _("Vif_type parameter must be present "
-                  "for this vif_driver implementation"))
+        self._check_vif_type(vif)
 
         self.unplug_ovs_hybrid(instance, vif)
 
+    def unplug_vifs(self, instance, network_info):
+        """Unplug every VIF of network_info with one OVS transaction."""
+        for vif in network_info:
+            self._check_vif_type(vif)
+
+        self.unplug_ovs_hybrid_vifs(instance, network_info)
+
     def unplug_ovs_hybrid(self, instance, vif):
         """UnPlug using hybrid strategy
 
         Unhook port from OVS, unhook port from bridge, delete
         bridge, and delete both veth devices.
         """
-        try:
-            br_name = self.get_br_name(vif['id'])
-            vm_port_name = self.get_vm_ovs_port_name(vif['id'])
-
-            if linux_net.device_exists(br_name):
-                utils.execute('brctl', 'delif', br_name, vm_port_name,
-                              run_as_root=True)
-                utils.execute('ip', 'link', 'set', br_name, 'down',
-                              run_as_root=True)
-                utils.execute('brctl', 'delbr', br_name,
-                              run_as_root=True)
+        self.unplug_ovs_hybrid_vifs(instance, [vif])
 
-            linux_net.delete_ovs_vif_port(self.get_bridge_name(vif), vm_port_name)
-        except processutils.ProcessExecutionError:
-            LOG.exception(_("Failed while unplugging vif for %s"), instance)
+    def unplug_ovs_hybrid_vifs(self, instance, network_info):
+        """Unplug each VIF on its own, a failure doesn't stop the others.
 
-    def attach(self, vif, instance, container_id, new_remote_name):
+        The OVS ports are deleted in one transaction, committed whatever
+        happened to the bridges.
+        """
+        txn = linux_net.OVSTransaction()
+        try:
+            for vif in network_info:
+                br_name = self.get_br_name(vif['id'])
+                vm_port_name = self.get_vm_ovs_port_name(vif['id'])
+                try:
+                    if linux_net.device_exists(br_name):
+                        utils.execute('brctl', 'delif', br_name,
+                                      vm_port_name, run_as_root=True)
+                        utils.execute('ip', 'link', 'set', br_name, 'down',
+                                      run_as_root=True)
+                        utils.execute('brctl', 'delbr', br_name,
+                                      run_as_root=True)
+                except processutils.ProcessExecutionError:
+                    LOG.exception(_("Failed while unplugging vif %s for %s"),
+                                  vif['id'], instance)
+
+                linux_net.delete_ovs_vif_port(self.get_bridge_name(vif),
+                                              vm_port_name, txn=txn)
+        finally:
+            try:
+                txn.commit()
+            except processutils.ProcessExecutionError:
+                LOG.exception(_("Failed while deleting the ovs ports of %s"),
+                              instance)
+
+    def attach(self, vif, instance, container_id, new_remote_name,
+               reraise=False):
+        """Move a new veth end into the container as `new_remote_name`.
+
+        Failures are only logged unless `reraise` is set.
+        """
         vif_type = vif['type']
         if_local_name = 'tap%s' % vif['id'][:11]
         if_remote_name = 'ns%s' % vif['id'][:11]
@@ -219,7 +301,14 @@ class GenericVIFDriver(object):
                           run_as_root=True)
 
         except Exception as e:
-            LOG.exception(_("Failed to attach vif: %s"), str(e.message))
+            with excutils.save_and_reraise_exception(reraise=reraise):
+                LOG.exception(_("Failed to attach vif: %s"), str(e.message))
+
+    def detach(self, vif, instance):
+        """Remove the host end of an attached veth pair, and its peer."""
+        LOG.debug('detach vif %(vif)s instance=%(instance)s',
+                  {'vif': vif['id'], 'instance': instance})
+        linux_net.delete_net_dev('tap%s' % vif['id'][:11])
 
     def get_bridge_name(self, vif):
         return 'br-int'
@@ -243,3 +332,57 @@ class GenericVIFDriver(object):
     def get_vm_ovs_port_name(self, iface_id):
         return ("qvm%s" % iface_id)[:network_model.NIC_NAME_LEN]
 
+
+class NetlinkVIFDriver(GenericVIFDriver):
+    """VIF driver that wires the container side through rtnetlink.
+
+    Plugging is shared with GenericVIFDriver; attach creates the veth
+    pair with its peer directly inside the container netns and configures
+    it over netlink/ioctl sockets instead of forking ip, brctl and ethtool.
+    """
+
+    def attach(self, vif, instance, container_id, new_remote_name,
+               reraise=False):
+        vif_type = vif['type']
+        if_local_name = 'tap%s' % vif['id'][:11]
+        br_name = self.get_br_name(vif['id'])
+        gateway = network.find_gateway(instance, vif['network'])
+        ip = network.find_fixed_ip(instance, vif['network'])
+        netns_path = '/var/run/netns/{0}'.format(container_id)
+
+        LOG.debug('attach vif_type=%(vif_type)s instance=%(instance)s '
+                  'vif=%(vif)s',
+                  {'vif_type': vif_type, 'instance': instance,
+                   'vif': vif})
+
+        mtu = 1300
+        if vif.get('mtu') is not None:
+            mtu = vif.get('mtu')
+
+        try:
+            netns_fd = os.open(netns_path, os.O_RDONLY)
+            try:
+                with netlink.IPRoute() as host:
+                    if host.link_lookup(if_local_name) is not None:
+                        host.link_del(if_local_name)
+
+                    host.link_add_veth(if_local_name, new_remote_name,
+                                       peer_netns_fd=netns_fd,
+                                       peer_address=vif['address'],
+                                       peer_mtu=mtu)
+                    host.link_set(if_local_name, up=True,
+                                  master=host.link_index(br_name))
+            finally:
+                os.close(netns_fd)
+
+            with netlink.IPRoute(netns_path) as ns:
+                ns.addr_add(new_remote_name, ip)
+                ns.link_set(new_remote_name, up=True)
+                if gateway is not None:
+                    ns.route_replace_default(gateway, new_remote_name)
+                # Disable TSO, for now no config option
+                ns.set_tso(new_remote_name, False)
+
+        except Exception as e:
+            with excutils.save_and_reraise_exception(reraise=reraise):
+                LOG.exception(_("Failed to attach vif: %s"), str(e))
@@ -10,6 +10,7 @@ from wormhole import exception
 from wormhole.i18n import _
 from wormhole.common import log as logging
 from wormhole.common import service
+from wormhole.common import timeline
 from wormhole import wsgi
 
 CONF = cfg.CONF
@@ -28,7 +29,8 @@ class WSGIService(object):
         self.name = name
         self.manager = self._get_manager()
         self.loader = loader or wsgi.Loader()
-        self.app = self.loader.load_app(name)
+        with timeline.phase('api_load'):
+            self.app = self.loader.load_app(name)
         self.host = '0.0.0.0'
         self.port = CONF.get('port', 7127)
         self.workers = 1
@@ -79,14 +81,16 @@ class WSGIService(object):
         :returns: None
 
         """
-        if self.manager:
-            self.manager.init_host()
-            self.manager.pre_start_hook()
-            if self.backdoor_port is not None:
-                self.manager.backdoor_port = self.backdoor_port
-        self.server.start()
-        if self.manager:
-            self.manager.post_start_hook()
+        with timeline.phase('api_start'):
+            if self.manager:
+                self.manager.init_host()
+                self.manager.pre_start_hook()
+                if self.backdoor_port is not None:
+                    self.manager.backdoor_port = self.backdoor_port
+            self.server.start()
+            if self.manager:
+                self.manager.post_start_hook()
+        self.server.notify_ready()
 
     def stop(self):
         """Stop serving this API.
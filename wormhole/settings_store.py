@@ -0,0 +1,151 @@
+from oslo.config import cfg
+
+from wormhole.common import jsonutils
+from wormhole.common import log
+from wormhole.i18n import _
+
+import copy
+import os
+
+settings_opts = [
+    cfg.IntOpt('settings_compact_records',
+        default=64,
+        help='Number of change records appended to the settings journal '
+             'before they are folded into a new settings snapshot.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(settings_opts)
+
+LOG = log.getLogger(__name__)
+
+
+def _write_durably(path, data):
+    """ Replace `path` with `data`: write a temp file, fsync, rename. """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class SettingsStore(object):
+    """ The settings document, kept in memory and persisted incrementally.
+
+    Changes are appended to `<path>.journal` as small idempotent records
+    and folded into the snapshot at `path` every settings_compact_records
+    changes and whenever the store is loaded, so readers of the snapshot
+    (the boot scripts) see the state of the last run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self._doc = None
+        self._journal = None
+        self._records = 0
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            content = f.read()
+        # the setting scripts may hand it over compressed
+        try:
+            content = content.decode('base64').decode('zlib')
+        except Exception:
+            pass
+        return jsonutils.loads(content) if content.strip() else {}
+
+    def load(self):
+        """ The document, read and compacted on first use. """
+        if self._doc is not None:
+            return self._doc
+        self._doc = self._read_snapshot()
+        self._records = self._replay(self._doc)
+        if self._records:
+            self.compact()
+        return self._doc
+
+    def _replay(self, doc):
+        """ Apply the journal to `doc`, returns its number of records. """
+        records = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        self._apply(doc, jsonutils.loads(line))
+                    except ValueError:
+                        # torn write at the end of the journal
+                        LOG.warn(_("Skip corrupted settings record %r"), line)
+                    records += 1
+        return records
+
+    def _apply(self, doc, record):
+        op, key = record['op'], record['key']
+        if op == 'set':
+            doc[key] = record['value']
+        elif op in ('put_item', 'remove_item'):
+            items = doc.setdefault(key, [])
+            item_id = record['id']
+            idx = next((i for i, item in enumerate(items)
+                        if item.get('id') == item_id), -1)
+            if op == 'remove_item':
+                if idx >= 0:
+                    items.pop(idx)
+            elif idx >= 0:
+                items[idx] = record['value']
+            else:
+                items.append(record['value'])
+
+    def _change(self, record):
+        self.load()
+        self._apply(self._doc, record)
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(jsonutils.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._records += 1
+        if self._records >= CONF.settings_compact_records:
+            self.compact()
+
+    def get(self, key, default=None):
+        return copy.deepcopy(self.load().get(key, default))
+
+    def set(self, key, value):
+        self._change({'op': 'set', 'key': key, 'value': value})
+
+    def put_item(self, key, item):
+        """ Add `item` to the list at `key`, replacing the one with its id. """
+        self._change({'op': 'put_item', 'key': key, 'id': item['id'],
+                      'value': item})
+
+    def remove_item(self, key, item_id):
+        self._change({'op': 'remove_item', 'key': key, 'id': item_id})
+
+    def compact(self):
+        """ Publish the document as the snapshot and empty the journal.
+
+        The snapshot is read again and the journal replayed on it, rather
+        than dumping the document in memory: the setting scripts may have
+        rewritten the snapshot since it was loaded.
+        """
+        doc = self._read_snapshot()
+        self._replay(doc)
+        _write_durably(self.path, jsonutils.dumps(doc))
+        self._doc = doc
+        # a crash before this point only replays records already in the
+        # snapshot, which is harmless as they are idempotent
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+        self._records = 0
@@ -0,0 +1,90 @@
+import eventlet
+from eventlet import semaphore
+from oslo.config import cfg
+
+from wormhole.common import inotify
+from wormhole.common import log
+from wormhole.common import loopingcall
+from wormhole.i18n import _
+from wormhole.lxc_client import LXC_CGROUP_ROOT
+
+import time
+
+state_cache_opts = [
+    cfg.IntOpt('container_state_max_age',
+        default=30,
+        help='Seconds after which the cached container state is refreshed '
+             'even if no lifecycle operation or cgroup event was seen. '
+             '0 disables the background refresh.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(state_cache_opts)
+
+LOG = log.getLogger(__name__)
+
+
+class ContainerStateCache(object):
+    """ In-memory copy of the container manager's list().
+
+    The copy is refreshed after every lifecycle operation (by the
+    caller), whenever a container cgroup appears or disappears, and at
+    worst every container_state_max_age seconds, so reads never fork.
+    """
+
+    def __init__(self, manager, max_age=None):
+        self._manager = manager
+        self._max_age = CONF.container_state_max_age if max_age is None \
+                            else max_age
+        self._containers = None
+        self._refreshed_at = 0
+        self._lock = semaphore.Semaphore()
+        self._started = False
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        if self._max_age > 0:
+            poller = loopingcall.FixedIntervalLoopingCall(self._poll)
+            poller.start(interval=self._max_age, initial_delay=self._max_age)
+        eventlet.spawn_n(self._watch_cgroups)
+
+    def _poll(self):
+        if time.time() - self._refreshed_at >= self._max_age:
+            self._poll_now()
+
+    def _watch_cgroups(self):
+        try:
+            with inotify.Inotify() as watcher:
+                if not watcher.add_watch(LXC_CGROUP_ROOT,
+                                         inotify.IN_CREATE | inotify.IN_DELETE):
+                    LOG.info(_("%s doesn't exist, container state is only "
+                               "refreshed periodically"), LXC_CGROUP_ROOT)
+                    return
+                while True:
+                    if watcher.wait(None):
+                        self._poll_now()
+        except Exception as e:
+            LOG.warn(_("Stop watching container cgroups: %s"), e)
+
+    def _poll_now(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            LOG.warn(_("Failed to refresh container state: %s"), e)
+
+    def refresh(self):
+        """ Reload the state from the manager and return it. """
+        with self._lock:
+            containers = self._manager.list(all=True)
+            self._containers = containers
+            self._refreshed_at = time.time()
+        return containers
+
+    def list(self):
+        """ The cached containers, loading them on first use. """
+        self._start()
+        if self._containers is None:
+            return self.refresh()
+        return self._containers
@@ -1,3 +1,4 @@
+import six
 import webob
 
 from wormhole import exception
@@ -8,53 +9,209 @@ from wormhole.common import jsonutils
 from wormhole.common import processutils
 from wormhole.common import excutils
 from wormhole.common import log
+import eventlet
+from eventlet import event
 from eventlet import greenthread
+from eventlet import patcher
+from oslo.config import cfg
+
+import bisect
+import collections
+import itertools
+import os
+import time
+
+task_opts = [
+    cfg.IntOpt('task_max_running',
+               default=8,
+               help='Maximum number of tasks running at once, the others '
+                    'wait in a queue.'),
+    cfg.DictOpt('task_kind_concurrency',
+                default={'volume_copy': 2, 'image': 1},
+                help='Maximum number of running tasks per kind of task, '
+                     'as kind:count pairs. Kinds not listed are only '
+                     'bound by task_max_running.'),
+    cfg.StrOpt('task_journal_path',
+               default='/var/lib/wormhole/tasks.journal',
+               help='Append-only log of task state changes, used to keep '
+                    'task ids unique and answer for finished tasks across '
+                    'restarts.'),
+    cfg.IntOpt('task_retention_seconds',
+               default=86400,
+               help='Seconds a finished task can still be queried.'),
+    cfg.IntOpt('task_retention_count',
+               default=1000,
+               help='Maximum number of finished tasks kept for queries, '
+                    'the oldest are forgotten first.'),
+    cfg.DictOpt('task_kind_timeout',
+                default={},
+                help='Seconds a running task of a kind may take before it '
+                     'is stopped and reported as timed out, as kind:seconds '
+                     'pairs.'),
+    cfg.IntOpt('task_max_wait',
+               default=60,
+               help='Upper bound in seconds of the wait parameter of task '
+                    'queries.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(task_opts)
 
 LOG = log.getLogger(__name__)
 
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# progress is reported from native (tpool) threads too
+_threading = patcher.original('threading')
+
+
+class Progress(object):
+    """ Byte progress of a task, callable with the bytes just handled. """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.stopped = None
+        self.cancelled = False
+        self._started_at = time.time()
+        self._lock = _threading.Lock()
+
+    def __call__(self, nbytes):
+        if self.stopped is not None:
+            # unwinds the copy loops at their next chunk
+            raise exception.TaskCancelled(id=self.stopped)
+        with self._lock:
+            self.done += nbytes
+
+    def stop(self, task_id, cancelled=False):
+        """ Make the next call raise, `cancelled' if the user asked. """
+        self.stopped = task_id
+        self.cancelled = cancelled
+
+    def status(self):
+        done = min(self.done, self.total)
+        elapsed = max(time.time() - self._started_at, 0.001)
+        throughput = done / elapsed
+        eta = int((self.total - done) / throughput) if throughput else None
+        return {"bytes_done": done,
+                "bytes_total": self.total,
+                "percent": 100 * done // self.total if self.total else 100,
+                "throughput": int(throughput),
+                "eta": eta}
+
+
 
 class Task(object):
     TASK_DOING = 0
     TASK_SUCCESS = 1
     TASK_ERROR = 2
+    TASK_CANCELLED = 3
+    TASK_TIMEOUT = 4
     FORMAT_MAP = {
             TASK_DOING: "doing",
             TASK_SUCCESS: "successful",
-            TASK_ERROR: "error with {}"
+            TASK_ERROR: "error with {}",
+            TASK_CANCELLED: "cancelled",
+            TASK_TIMEOUT: "timed out"
     }
     def __init__(self, tid, callback, *args, **kwargs):
         self.tid = str(tid)
         self.callback = callback
+        self.progress = kwargs.pop('progress', None)
+        self.kind = kwargs.pop('kind', None)
+        self.priority = kwargs.pop('priority', PRIORITY_NORMAL)
+        self.timeout = kwargs.pop('timeout', None)
+        self.fingerprint = kwargs.pop('fingerprint', None)
         self.args = args
         self.kwargs = kwargs
         self._code = self.TASK_DOING
         self._msg = ''
+        self.queue_position = None
+        self._changed = event.Event()
+        self._stop_code = None
+        self._process_groups = processutils.ProcessGroups()
+
+    def _notify(self):
+        changed, self._changed = self._changed, event.Event()
+        changed.send()
 
-    def start(self):
+    def wait(self):
+        """ Block the greenthread until the task changes state. """
+        self._changed.wait()
+
+    def start(self, on_done=None):
 
         def _inner():
             """Read data from the input and write the same to the output
             until the transfer completes.
             """
+            processutils.track_process_groups(self._process_groups)
             try:
                 LOG.debug("starting doing task")
                 self.callback(*self.args, **self.kwargs)
                 self._code = self.TASK_SUCCESS
                 LOG.debug("ending doing task")
             except Exception as e:
-                LOG.exception(e)
-                self._code = self.TASK_ERROR
-                self._msg = str(e.message)
+                if self._stop_code is not None:
+                    LOG.info(_("Task %s stopped: %s"), self.tid, e)
+                    self._code = self._stop_code
+                else:
+                    LOG.exception(e)
+                    self._code = self.TASK_ERROR
+                    self._msg = str(e.message)
+            finally:
+                processutils.track_process_groups(None)
+                if deadline is not None:
+                    deadline.cancel()
+                if on_done:
+                    on_done(self)
+                self._notify()
 
+        timeout = self.timeout or CONF.task_kind_timeout.get(self.kind)
+        deadline = None
+        if timeout:
+            deadline = greenthread.spawn_after(float(timeout), self.stop,
+                                               self.TASK_TIMEOUT)
+        self.queue_position = None
         greenthread.spawn(_inner)
+        self._notify()
         return self
 
+    def stop(self, code=TASK_CANCELLED):
+        """ Stop the running callback, reporting `code` once it's unwound.
+
+        Commands it runs are killed with their whole process group and
+        copies reporting progress bail out at their next chunk; anything
+        else runs to its end.
+        """
+        if self._code != self.TASK_DOING or self._stop_code is not None:
+            return
+        LOG.info(_("Stopping task %s"), self.tid)
+        self._stop_code = code
+        if self.progress is not None:
+            self.progress.stop(self.tid,
+                               cancelled=code == self.TASK_CANCELLED)
+        self._process_groups.kill()
+        self._notify()
+
     def status(self):
-        return { "code": self._code,
-                 "message": "Task %s is " % self.tid +
-                        self.FORMAT_MAP.get(self._code, '').format(self._msg),
-                 "task_id": self.tid
-                }
+        if self.queue_position is not None:
+            state = "queued at position %d" % self.queue_position
+        elif self._code == self.TASK_DOING and self._stop_code is not None:
+            state = "being stopped"
+        else:
+            state = self.FORMAT_MAP.get(self._code, '').format(self._msg)
+        status = { "code": self._code,
+                   "message": "Task %s is " % self.tid + state,
+                   "task_id": self.tid
+                 }
+        if self.queue_position is not None:
+            status["queue_position"] = self.queue_position
+        if self.progress is not None:
+            status["progress"] = self.progress.status()
+        return status
 
     @staticmethod
     def success_task():
@@ -71,36 +228,344 @@ class Task(object):
 FAKE_SUCCESS_TASK = Task.success_task()
 FAKE_ERROR_TASK = Task.error_task()
 
+class TaskJournal(object):
+    """ Append-only log of task statuses, one JSON record per line.
+
+    The last record of a task wins. rewrite() replaces the log with just
+    the given statuses, plus the next free id so ids stay unique.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = None
+
+    def load(self):
+        """ Returns (next free id, {task id: (time, status)}). """
+        next_id = 0
+        statuses = {}
+        if not os.path.exists(self.path):
+            return next_id, statuses
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = jsonutils.loads(line)
+                except ValueError:
+                    # torn write at the end of the log
+                    LOG.warn(_("Skip corrupted task journal record %r"), line)
+                    continue
+                self.records += 1
+                if 'next_id' in record:
+                    next_id = max(next_id, record['next_id'])
+                    continue
+                tid = record['task_id']
+                statuses[tid] = (record['time'], record['status'])
+                if tid.isdigit():
+                    next_id = max(next_id, int(tid) + 1)
+        return next_id, statuses
+
+    def _open(self):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def append(self, status, timestamp=None):
+        record = {'task_id': status['task_id'], 'status': status,
+                  'time': timestamp or time.time()}
+        f = self._open()
+        f.write(jsonutils.dumps(record) + '\n')
+        f.flush()
+        self.records += 1
+
+    def rewrite(self, next_id, statuses):
+        """ Compact the log down to `statuses`: [(time, status), ...]. """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(jsonutils.dumps({'next_id': next_id}) + '\n')
+            for timestamp, status in statuses:
+                f.write(jsonutils.dumps({'task_id': status['task_id'],
+                                         'status': status,
+                                         'time': timestamp}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.records = len(statuses) + 1
+
+
 class TaskManager(object):
+    """ Runs tasks, queueing them beyond the configured concurrency.
+
+    Waiting tasks are started by priority then in arrival order, skipping
+    those whose kind is at its task_kind_concurrency limit so they don't
+    hold up tasks of other kinds.
+
+    Every state change is appended to a TaskJournal. Once finished, a task
+    is only kept as its final status, for task_retention_seconds and at
+    most task_retention_count of them, in memory as well as in the
+    journal.
+    """
     _task_mapping = {}
+    _inflight = {}
+    _finished = collections.OrderedDict()
     _free_id = 0
+    _waiting = []
+    _running = {}
+    _seq = itertools.count()
+    _journal = None
+
+    def _load(self):
+        """ Replay the journal, once the configuration is parsed. """
+        if TaskManager._journal is not None:
+            return
+        journal = TaskManager._journal = TaskJournal(CONF.task_journal_path)
+        try:
+            next_id, statuses = journal.load()
+        except (IOError, OSError, ValueError) as e:
+            LOG.warn(_("Can't load task journal %s: %s"), journal.path, e)
+            return
+        TaskManager._free_id = max(self._free_id, next_id)
+        for tid, (timestamp, status) in sorted(statuses.items(),
+                                               key=lambda i: i[1][0]):
+            if status['code'] == Task.TASK_DOING:
+                # died with the previous process, unless resumed
+                t = Task(tid, None)
+                t._code = t.TASK_ERROR
+                t._msg = 'interrupted by a restart'
+                status = t.status()
+            self._finished[tid] = (timestamp, status)
+        self._evict()
+        self._compact()
+
+    def _record(self, status):
+        try:
+            self._journal.append(status)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Can't write task journal %s: %s"),
+                     self._journal.path, e)
+
+    def _evict(self):
+        oldest = time.time() - CONF.task_retention_seconds
+        for tid, (timestamp, _status) in list(self._finished.items()):
+            if (len(self._finished) <= CONF.task_retention_count and
+                    timestamp >= oldest):
+                break
+            del self._finished[tid]
+
+    def _compact(self):
+        live = len(self._finished) + len(self._task_mapping)
+        if self._journal.records <= max(100, 2 * live):
+            return
+        statuses = list(self._finished.values())
+        statuses.extend((time.time(), t.status())
+                        for t in self._task_mapping.values())
+        try:
+            self._journal.rewrite(self._free_id, statuses)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Can't compact task journal %s: %s"),
+                     self._journal.path, e)
 
     def add_task(self, callback, *args, **kwargs):
+        """ Run callback(*args, **kwargs) as a task.
+
+        These keywords are kept by the task instead of being passed on:
+        `progress` (a Progress the callback updates, published in the
+        task status), `kind` (the concurrency class), `priority` (one of
+        the PRIORITY_* values), `timeout` (seconds before it's stopped) and
+        `fingerprint` (a hashable identifying the operation: while a task
+        with the same fingerprint is queued or running, its status is
+        returned instead of starting another one).
+        """
+        # ids continue from the journal of the previous run
+        self._load()
+        existing = self.find_task(kwargs.get('fingerprint'))
+        if existing is not None:
+            LOG.info(_("Task %s is already doing %s"), existing['task_id'],
+                     kwargs['fingerprint'])
+            return existing
         task_id = str(self._free_id)
+        return self.resume_task(task_id, callback, *args, **kwargs)
+
+    def find_task(self, fingerprint):
+        """ Status of the in-flight task with this fingerprint, or None. """
+        if fingerprint is None:
+            return None
+        task_id = self._inflight.get(fingerprint)
+        if task_id is None:
+            return None
+        return self._task_mapping[task_id].status()
+
+    def resume_task(self, task_id, callback, *args, **kwargs):
+        """ Run a task under a given id, e.g. one picked up after a restart. """
+        self._load()
         t = Task(task_id, callback, *args, **kwargs)
-        self._task_mapping[task_id] = t
-        t.start()
-        self._free_id += 1
+        self._finished.pop(t.tid, None)
+        self._task_mapping[t.tid] = t
+        if t.fingerprint is not None:
+            self._inflight[t.fingerprint] = t.tid
+        if t.tid.isdigit():
+            TaskManager._free_id = max(self._free_id, int(t.tid) + 1)
+        bisect.insort(self._waiting, (t.priority, next(self._seq), t))
+        self._schedule()
+        status = t.status()
+        if t.queue_position is not None:
+            self._record(status)
+        return status
+
+    def _can_run(self, kind):
+        if sum(self._running.values()) >= CONF.task_max_running:
+            return False
+        limit = CONF.task_kind_concurrency.get(kind)
+        return limit is None or self._running.get(kind, 0) < int(limit)
+
+    def _schedule(self):
+        waiting = []
+        for item in self._waiting:
+            t = item[-1]
+            if self._can_run(t.kind):
+                self._running[t.kind] = self._running.get(t.kind, 0) + 1
+                t.start(on_done=self._task_done)
+                self._record(t.status())
+            else:
+                waiting.append(item)
+                t.queue_position = len(waiting)
+        self._waiting[:] = waiting
+
+    def _finish(self, t):
+        status = t.status()
+        if self._task_mapping.get(t.tid) is t:
+            del self._task_mapping[t.tid]
+        if self._inflight.get(t.fingerprint) == t.tid:
+            del self._inflight[t.fingerprint]
+        self._finished[t.tid] = (time.time(), status)
+        self._record(status)
+        self._evict()
+        self._compact()
+
+    def _task_done(self, t):
+        self._running[t.kind] -= 1
+        self._finish(t)
+        self._schedule()
+
+    def cancel_task(self, task_id):
+        """ Drop a queued task or stop a running one. """
+        self._load()
+        t = self._task_mapping.get(task_id)
+        if t is None:
+            return self.query_task(task_id)
+        for item in self._waiting:
+            if item[-1] is t:
+                self._waiting.remove(item)
+                t.queue_position = None
+                t._code = t.TASK_CANCELLED
+                self._finish(t)
+                self._schedule()
+                t._notify()
+                break
+        else:
+            t.stop()
         return t.status()
 
+    def wait_tasks(self, task_ids, timeout):
+        """ Block until one of the unfinished tasks changes state.
+
+        Returns at once if none of them is still queued or running, and
+        after at most `timeout` seconds otherwise.
+        """
+        tasks = [self._task_mapping[tid] for tid in task_ids
+                 if tid in self._task_mapping]
+        if not tasks or timeout <= 0:
+            return
+        changed = event.Event()
+
+        def _waiter(t):
+            t.wait()
+            if not changed.ready():
+                changed.send()
+
+        waiters = [eventlet.spawn(_waiter, t) for t in tasks]
+        try:
+            with eventlet.Timeout(timeout, False):
+                changed.wait()
+        finally:
+            for gt in waiters:
+                gt.kill()
+
     def query_task(self, task_id):
+        self._load()
         task = self._task_mapping.get(task_id)
-        if not task:
-            raise exception.TaskNotFound(id=task_id)
-        return task.status()
+        if task:
+            return task.status()
+        if task_id in self._finished:
+            return self._finished[task_id][1]
+        raise exception.TaskNotFound(id=task_id)
 
 _tmanger = TaskManager()
 
 addtask = _tmanger.add_task
+resumetask = _tmanger.resume_task
+findtask = _tmanger.find_task
 
 class TaskController(wsgi.Application):
-    def query(self, request, task):
+
+    def _wait_param(self, request, wait):
+        if wait is None:
+            wait = request.params.get('wait')
+        if wait is None:
+            return 0
+        try:
+            wait = float(wait)
+        except ValueError:
+            raise exception.InvalidInput(
+                reason=_("wait must be a number of seconds, not %s") % wait)
+        return min(max(wait, 0), CONF.task_max_wait)
+
+    def query(self, request, task, wait=None):
+        """ Status of a task, after its next state change if `wait`ing. """
+        _tmanger.wait_tasks([task], self._wait_param(request, wait))
         return _tmanger.query_task(task)
 
+    def cancel(self, request, task):
+        """ Cancel a task, returns its status. """
+        return _tmanger.cancel_task(task)
+
+    def query_many(self, request, ids=None, wait=None):
+        """ Statuses of the tasks listed in `ids` (comma separated).
+
+        With `wait`, answers once any of them changes state. Unknown ids
+        are listed under not_found.
+        """
+        if ids is None:
+            ids = ','.join(request.params.getall('ids'))
+        if isinstance(ids, six.string_types):
+            ids = ids.split(',')
+        task_ids = [str(tid).strip() for tid in ids if str(tid).strip()]
+        _tmanger.wait_tasks(task_ids, self._wait_param(request, wait))
+        tasks, not_found = [], []
+        for tid in task_ids:
+            try:
+                tasks.append(_tmanger.query_task(tid))
+            except exception.TaskNotFound:
+                not_found.append(tid)
+        return {"tasks": tasks, "not_found": not_found}
+
 def create_router(mapper):
     controller = TaskController()
 
+    mapper.connect('/tasks',
+                   controller=controller,
+                   action='query_many',
+                   conditions=dict(method=['GET']))
     mapper.connect('/tasks/{task}',
                    controller=controller,
                    action='query',
                    conditions=dict(method=['GET']))
+    mapper.connect('/tasks/{task}',
+                   controller=controller,
+                   action='cancel',
+                   conditions=dict(method=['DELETE']))
@@ -1,7 +1,9 @@
 import webob
 from wormhole import exception
 from wormhole import wsgi
-from wormhole.tasks import addtask
+from wormhole.tasks import addtask, findtask, resumetask, Progress
+from wormhole.common import blockdev
+from wormhole.common import jsonutils
 from wormhole.common import utils
 from wormhole.common import units
 
@@ -9,7 +11,8 @@ from oslo.config import cfg
 from wormhole.common import log
 from wormhole.i18n import _
 
-import functools
+import base64
+import glob
 import uuid
 import os
 
@@ -20,6 +23,16 @@ volume_opts = [
     cfg.StrOpt('volume_dd_blocksize',
                default='1M',
                help='The default block size used when copying volume'),
+    cfg.BoolOpt('volume_scan_scsi_hosts',
+               default=False,
+               help='Rescan every SCSI host before listing devices even '
+                    'when block device uevents are watched. Only needed '
+                    'for LUNs the hypervisor adds without a hot-plug '
+                    'event.'),
+    cfg.StrOpt('volume_clone_checkpoint_dir',
+               default='/var/lib/wormhole/.clone-checkpoints',
+               help='The dir where running volume clones record the ranges '
+                    'already copied, so they resume after a restart.'),
 ]
 
 CONF.register_opts(volume_opts)
@@ -28,15 +41,133 @@ CONF.import_opt('container_volume_link_dir', 'wormhole.container')
 def volume_link_path(volume_id):
     return os.path.sep.join([CONF.get('container_volume_link_dir'), volume_id])
 
+class CloneCheckpoint(object):
+    """ Persisted bitmap of the ranges of a clone already copied. """
+
+    def __init__(self, info):
+        self.info = info
+        self._done = bytearray(base64.b64decode(info['done']))
+        self.progress = Progress(info['size_in_m'] * units.Mi)
+
+    @staticmethod
+    def path(volume_id):
+        return os.path.join(CONF.volume_clone_checkpoint_dir,
+                            '%s.json' % volume_id)
+
+    @classmethod
+    def create(cls, src_id, volume_id, size_in_m):
+        range_size = max(1, CONF.volume_copy_range_size) * units.Mi
+        nranges = (size_in_m * units.Mi + range_size - 1) // range_size
+        done = bytes(bytearray((nranges + 7) // 8))
+        return cls({'src_id': src_id,
+                    'volume_id': volume_id,
+                    'size_in_m': size_in_m,
+                    'range_size': range_size,
+                    'done': base64.b64encode(done)})
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(jsonutils.load(f))
+
+    @property
+    def range_size(self):
+        return self.info['range_size']
+
+    def is_done(self, index):
+        return bool(self._done[index // 8] & (1 << index % 8))
+
+    def mark_done(self, index):
+        self._done[index // 8] |= 1 << index % 8
+        self.save()
+
+    def save(self):
+        self.info['done'] = base64.b64encode(bytes(self._done))
+        path = self.path(self.info['volume_id'])
+        if not os.path.exists(CONF.volume_clone_checkpoint_dir):
+            os.makedirs(CONF.volume_clone_checkpoint_dir)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            jsonutils.dump(self.info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path(self.info['volume_id']))
+        except OSError:
+            pass
+
+
 class VolumeController(wsgi.Application):
 
     def __init__(self):
         super(VolumeController, self).__init__()
         self.volume_device_mapping = {}
+        self._resume_clones()
+
+    def _resume_clones(self):
+        """ Pick up the clones interrupted by a restart of the service. """
+        pattern = os.path.join(CONF.volume_clone_checkpoint_dir, '*.json')
+        for path in glob.glob(pattern):
+            try:
+                checkpoint = CloneCheckpoint.load(path)
+                info = checkpoint.info
+                srcstr = self._get_device(info['src_id'])
+                dststr = self._get_device(info['volume_id'])
+            except Exception as e:
+                LOG.warn(_("Can't resume volume clone from %s: %s"), path, e)
+                continue
+            task = resumetask(info['task_id'], self._clone_callback(
+                                  srcstr, dststr, checkpoint),
+                              progress=checkpoint.progress,
+                              kind='volume_copy',
+                              fingerprint=('clone_volume', srcstr, dststr))
+            LOG.info(_("Resumed clone volume task %s"), task)
+
+    def _clone_callback(self, srcstr, dststr, checkpoint):
+        size_in_m = checkpoint.info['size_in_m']
+
+        def _clone():
+            try:
+                utils.copy_volume(srcstr, dststr, size_in_m,
+                                  CONF.volume_dd_blocksize,
+                                  progress=checkpoint.progress,
+                                  checkpoint=checkpoint)
+            except Exception:
+                # kept for a retry or a restart to resume from, unless
+                # the user cancelled the clone
+                if checkpoint.progress.cancelled:
+                    checkpoint.remove()
+                raise
+            checkpoint.remove()
+        return _clone
+
+    def _load_checkpoint(self, src_id, volume_id, size_in_m):
+        """ The checkpoint a failed clone of the same volumes left. """
+        path = CloneCheckpoint.path(volume_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            checkpoint = CloneCheckpoint.load(path)
+        except (IOError, ValueError) as e:
+            LOG.warn(_("Ignore volume clone checkpoint %s: %s"), path, e)
+            return None
+        info = checkpoint.info
+        if info.get('src_id') != src_id or info.get('size_in_m') != size_in_m:
+            LOG.info(_("Ignore volume clone checkpoint %s of another "
+                       "clone"), path)
+            return None
+        LOG.info(_("Resume volume clone from checkpoint %s"), path)
+        return checkpoint
 
     def list(self, request, scan=True):
         """ List all host devices. """
-        if scan:
+        # hot-plugged disks show up in the uevent driven index by
+        # themselves, a rescan would only stall the SCSI buses
+        if scan and (CONF.volume_scan_scsi_hosts or
+                     blockdev.get_index() is None):
             LOG.debug(_("Scaning host scsi devices"))
             utils.trycmd("bash", "-c", "for f in /sys/class/scsi_host/host*/scan; do echo '- - -' > $f; done")
         return { "devices" : [d['name'] for d in utils.list_device()] }
@@ -62,9 +193,25 @@ class VolumeController(wsgi.Application):
         dststr = self._get_device(volume["id"])
         size_in_g = min(int(src_vref['size']), int(volume['size']))
 
-        clone_callback = functools.partial(utils.copy_volume, srcstr, dststr,
-                                            size_in_g*units.Ki, CONF.volume_dd_blocksize)
-        task = addtask(clone_callback)
+        # a retry while the clone is running must not start a second
+        # writer on the device, nor reset its checkpoint
+        fingerprint = ('clone_volume', srcstr, dststr)
+        task = findtask(fingerprint)
+        if task is not None:
+            LOG.debug(_("Clone volume task %s already running"), task)
+            return task
+
+        checkpoint = self._load_checkpoint(src_vref["id"], volume["id"],
+                                           size_in_g*units.Ki)
+        if checkpoint is None:
+            checkpoint = CloneCheckpoint.create(src_vref["id"], volume["id"],
+                                                size_in_g*units.Ki)
+        clone_callback = self._clone_callback(srcstr, dststr, checkpoint)
+        task = addtask(clone_callback, progress=checkpoint.progress,
+                       kind='volume_copy', fingerprint=fingerprint)
+        # the task only runs once we yield, so this lands first
+        checkpoint.info['task_id'] = task['task_id']
+        checkpoint.save()
         LOG.debug(_("Clone volume task %s"), task)
 
         return task
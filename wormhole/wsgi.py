@@ -19,9 +19,11 @@
 
 from __future__ import print_function
 
+import errno
 import os.path
 import socket
 import ssl
+import stat
 import sys
 
 import eventlet
@@ -42,6 +44,7 @@ from wormhole import exception
 from wormhole.i18n import _
 from wormhole.common import excutils
 from wormhole.common import log as logging
+from wormhole.common import systemd
 
 wsgi_opts = [
     cfg.StrOpt('api_paste_config',
@@ -83,6 +86,14 @@ wsgi_opts = [
                     "If an incoming connection is idle for this number of "
                     "seconds it will be closed. A value of '0' means "
                     "wait forever."),
+    cfg.StrOpt('api_ready_file',
+               default='/var/run/wormhole/api.ready',
+               help='File holding "<pid> <port>" of the API while it '
+                    'serves requests, for the boot scripts.'),
+    cfg.StrOpt('api_ready_fifo',
+               default='/var/run/wormhole/api.ready.fifo',
+               help='FIFO the boot scripts wait on, written to once the '
+                    'API serves requests.'),
     ]
 CONF = cfg.CONF
 CONF.register_opts(wsgi_opts)
@@ -94,6 +105,13 @@ SUPPORTED_CONTENT_TYPES = (
     'application/xml',
 )
 
+# Bodies of these types are left unread for the application to stream.
+STREAMING_CONTENT_TYPES = (
+    'application/x-tar',
+    'application/x-gtar',
+    'multipart/form-data',
+)
+
 # These are typically automatically created by routes as either defaults
 # collection or member methods.
 _ROUTES_METHODS = [
@@ -109,6 +127,14 @@ _METHODS_WITH_BODY = [
 ]
 
 
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
 class Server(object):
     """Server class to manage a WSGI server, serving a WSGI application."""
 
@@ -171,6 +197,8 @@ class Server(object):
         (self.host, self.port) = self._socket.getsockname()[0:2]
         LOG.info(_("%(name)s listening on %(host)s:%(port)s"),
                  {'name': self.name, 'host': self.host, 'port': self.port})
+        # a previous run's, the scripts must wait for this one
+        self.clear_ready()
 
     def start(self):
         """Start serving a WSGI application.
@@ -257,6 +285,58 @@ class Server(object):
 
         self._server = eventlet.spawn(**wsgi_kwargs)
 
+    def notify_ready(self):
+        """Tell systemd and the boot scripts requests are served.
+
+        Publishes api_ready_file, then wakes whoever waits on the
+        api_ready_fifo FIFO. Call once the application is loaded and
+        start()ed.
+        """
+        systemd.notify_once()
+        path = CONF.api_ready_file
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'w') as f:
+                f.write('%d %d\n' % (os.getpid(), self.port))
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Unable to write ready file %(path)s: %(err)s"),
+                     {'path': path, 'err': e})
+        LOG.info(_("%(name)s ready on %(host)s:%(port)s"),
+                 {'name': self.name, 'host': self.host, 'port': self.port})
+        try:
+            if not stat.S_ISFIFO(os.stat(CONF.api_ready_fifo).st_mode):
+                return
+            fd = os.open(CONF.api_ready_fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # no FIFO, or nobody waiting on it
+            if e.errno not in (errno.ENOENT, errno.ENXIO):
+                LOG.warn(_("Unable to signal readiness on %(path)s: "
+                           "%(err)s"), {'path': CONF.api_ready_fifo,
+                                        'err': e})
+            return
+        try:
+            os.write(fd, 'READY=1\n')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        finally:
+            os.close(fd)
+
+    def clear_ready(self):
+        """Withdraw api_ready_file, before starting or stopping."""
+        try:
+            with open(CONF.api_ready_file) as f:
+                pid = int(f.read().split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return
+        if pid == os.getpid() or not _pid_alive(pid):
+            try:
+                os.unlink(CONF.api_ready_file)
+            except OSError:
+                pass
+
     def reset(self):
         """Reset server greenpool size to default.
 
@@ -275,6 +355,7 @@ class Server(object):
 
         """
         LOG.info(_("Stopping WSGI server."))
+        self.clear_ready()
 
         if self._server is not None:
             # Resize pool to stop new requests from being processed
@@ -1325,6 +1406,11 @@ class JsonBodyMiddleware(Middleware):
 
     """
     def process_request(self, request):
+        # Leave streamed bodies alone, reading them here would buffer
+        # the whole payload in memory
+        if request.content_type in STREAMING_CONTENT_TYPES:
+            return
+
         # Abort early if we don't have any work to do
         params_json = request.body
         if not params_json: